@@ -4,33 +4,58 @@
 
 from dataImporter import *
 from datamodel import TrackSession
-import folium
+from sessionCache import SessionCache
+import artifactCache
+from historyStore import HistoryStore
+import trackAnalytics
+import zones
 import math
 import argparse
-from jinja2 import Environment, FileSystemLoader
-from pdfkit import from_string
 import os, os.path, sys, io
-from PIL import Image
+import contextlib
 import utils
 import base64
 import numpy as np
-import matplotlib.pyplot as plt
+import profiling
+
+# The output backends - maps (mapRender, with folium or PIL), G-G and lap comparison plots (ggPlot and
+# deltaPlot, with matplotlib), the
+# report template (jinja2) and the PDF conversion (pdfkit) - are imported where they are first used, so
+# a run that only prints results doesn't load any of them.
 
 outputDir = "../RDA-output"
 
+# Part of the artifact cache keys of PDFs - bump when they change for the same HTML
+PDF_VERSION = 1
+
 parser = argparse.ArgumentParser(description='Run analysis on track data file')
 parser.add_argument('-f', '--file', action='append', help='Filename with data to be analyzed. Can be specified multiple times.')
 parser.add_argument('-v', '--verbose', action='count')
-parser.add_argument('-t', '--trackname', action='store', help='Name of track data is from, if not present in file (e.g. TrackAddict data). Can only analyze one track per run unless track name is present in datafile.')
+parser.add_argument('-t', '--trackname', action='store', help='Name of track data is from, if not present in file (e.g. TrackAddict data). Without it, the track is recognised from the GPS data.')
 parser.add_argument('--text-results', action=argparse.BooleanOptionalAction, help='Show results in text in terminal', default=False)
 parser.add_argument('--gg-maps', action=argparse.BooleanOptionalAction, help='Show G-G (inline and lateral acceleration) plots', default=False)
+parser.add_argument('--gg-style', choices=['auto', 'density', 'points'], default='auto', help='Draw G-G plots as a density map or one point per sample (auto: density for the session, points for single laps)')
 parser.add_argument('--gps-only', action=argparse.BooleanOptionalAction, help='Perform analysis only on GPS data (e.g. AIM Solo 2 non-DL data)', default=False)
 parser.add_argument('--save-image-files', action=argparse.BooleanOptionalAction, help='Save individual image files alongside PDF', default=False)
+parser.add_argument('--map-backend', choices=['folium', 'local'], default='folium', help='Render maps with folium and a headless browser over online tiles, or locally without a browser or network')
+parser.add_argument('--basemap', action='store', help='Background image for local map rendering, north-up, covering --basemap-bounds')
+parser.add_argument('--basemap-bounds', action='store', help='Area covered by --basemap, as SOUTH,WEST,NORTH,EAST in decimal degrees')
+parser.add_argument('--simplify', type=float, default=0.5, help='Drop map trace detail finer than this many pixels (0 draws every sample)')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to process in parallel worker processes')
+parser.add_argument('--render-jobs', type=int, default=1, help='Number of worker processes rendering map and chart images for each report')
+parser.add_argument('--cache', action=argparse.BooleanOptionalAction, help='Reuse previously processed sessions for unchanged data files', default=True)
+parser.add_argument('--cache-dir', action='store', help='Directory for the processed session cache (default: ~/.cache/PyRDA/sessions)')
+parser.add_argument('--history', action=argparse.BooleanOptionalAction, help='Record sessions in the history store and show the track records from it', default=True)
+parser.add_argument('--history-db', action='store', help='Session history database (default: ~/.local/share/PyRDA/history.sqlite3)')
+parser.add_argument('--artifact-cache', action=argparse.BooleanOptionalAction, help='Reuse map images, plots and PDFs whose inputs have not changed since an earlier run', default=True)
+parser.add_argument('--artifact-dir', action='store', help='Directory for the artifact cache (default: ~/.cache/PyRDA/artifacts)')
 gengroup = parser.add_argument_group("General analysis options")
+gengroup.add_argument('--report', action=argparse.BooleanOptionalAction, help='Write the PDF report (default: only without --text-results)')
 gengroup.add_argument('--laps', action=argparse.BooleanOptionalAction, help='Show / don\'t show lap data', default=True)
 gengroup.add_argument('--segments', action=argparse.BooleanOptionalAction, help='Show / don\'t show segment data')
 gengroup.add_argument('--list-datapoints', action='store_true', help='List the data points available in the file(s)')
 gengroup.add_argument('--combined-lap-map', action=argparse.BooleanOptionalAction, help='Show a map of all laps driven', default=True)
+gengroup.add_argument('--lap-deltas', action=argparse.BooleanOptionalAction, help='Show the time each hot lap gains and loses against the fastest one, and their speeds, along the lap', default=False)
 gengroup.add_argument('--individual-lap-maps', action=argparse.BooleanOptionalAction, help='Show maps of the individual laps', default=False)
 segparser = parser.add_argument_group('Segment analysis options')
 segparser.add_argument('--delta', action=argparse.BooleanOptionalAction, help='Show segment time deltas from best segment time', default=True)
@@ -38,8 +63,19 @@ segparser.add_argument('--brake', action=argparse.BooleanOptionalAction, help='D
 segparser.add_argument('--throttle', action=argparse.BooleanOptionalAction, help='Display segment maps showing throttle application', default=True)
 spcparser = parser.add_argument_group("Special arguments")
 spcparser.add_argument('--no-trim-tail', action='store_true', help="Don't trim the in-lap - use when session is red-flagged")
+spcparser.add_argument('--profile', action='store', help='Write the time, CPU time and peak memory of every stage of the run to this file')
+spcparser.add_argument('--profile-format', choices=['json', 'chrome'], default='json', help='Format of the --profile file: a JSON summary, or a Chrome trace (chrome://tracing, Perfetto)')
+spcparser.add_argument('--profile-memory', action=argparse.BooleanOptionalAction, help='Measure peak memory of each stage with --profile (slows the run down)', default=True)
+
+# Set by main(), and in worker processes by setArgs()
+args = None
 
-args = parser.parse_args()
+def setArgs(newArgs):
+    global args
+    args = newArgs
+    # --text-results on its own is a terminal-only run: no PDF, and none of the imports it needs
+    if args.report is None:
+        args.report = not args.text_results
 
 def debugout(debuglevel, text):
     if args.verbose and debuglevel >= args.verbose:
@@ -49,22 +85,63 @@ def textout(text):
     if args.text_results:
         print(text)
 
-def analyze(session):
+basemap = None
+
+# Loaded on first use, once per process
+def getBasemap():
+    import mapRender
+    global basemap
+    if args.basemap and basemap is None:
+        basemap = mapRender.Basemap(args.basemap, [float(v) for v in args.basemap_bounds.split(',')])
+    return basemap
+
+# What a map image's cache key needs to know about the basemap: which file, which version of it, and
+# where it is
+def getBasemapIdentity():
+    if not args.basemap:
+        return None
+    info = os.stat(args.basemap)
+    return [os.path.abspath(args.basemap), info.st_mtime_ns, info.st_size, args.basemap_bounds]
+
+def getImageKey(job):
+    import mapRender, ggPlot, deltaPlot
+    kind, spec = job
+    if "map" == kind:
+        return utils.makeKey("map", mapRender.RENDERER_VERSION, args.map_backend, getBasemapIdentity(), spec.getKeyParts())
+    if "delta" == kind:
+        return utils.makeKey(kind, deltaPlot.RENDERER_VERSION, spec)
+    return utils.makeKey(kind, ggPlot.RENDERER_VERSION, spec)
+
+# Render one image job from analyze() to PNG data. Runs in the worker processes with --render-jobs.
+def renderImage(job):
+    import ggPlot, deltaPlot
+    kind, spec = job
+    if "map" == kind:
+        return spec.render(args.map_backend, getBasemap())
+    if "gg" == kind:
+        return ggPlot.render(*spec)
+    if "delta" == kind:
+        return deltaPlot.render(*spec)
+    raise ValueError("Unknown image job: "+str(kind))
+
+def from_string(html, path):
+    import pdfkit
+    return pdfkit.from_string(html, path)
+
+# renderImage as a profile stage of its own. The records go back with the image, so they make it out of
+# the --render-jobs worker processes.
+def renderImageProfiled(item):
+    name, job = item
+    def render():
+        with profiling.stage(name, "image", kind=job[0]):
+            return renderImage(job)
+    return profiling.collect(render)
+
+def analyze(session, records=None):
     debugout(1, "Entered analyze")
-    mapsList = {}
-    outputFilename = '-'.join([session.getSessionInfo("driverName"),
-                               session.getSessionInfo("trackName"),
-                               session.getSessionInfo("simpleDate"),
-                               session.getSessionInfo("sessionTime")])
-    outputFilename = outputFilename.replace(" ", "-")
-    outputFilename = outputFilename.replace(",", "-")
-    outputFilename = outputFilename.replace(":", "-")
-    if os.path.exists(outputFilename+'.pdf'):
-        increment=1
-        while os.path.exists(outputFilename+"-"+str(increment)+'.pdf'):
-            increment+=1
-        outputFilename += '-'+str(increment)
-    outputFilename += '.pdf'
+    zoneList = {}
+    with profiling.stage("summary"):
+        summary = session.getSummary()
 
 #    debugout (2, "Number of laps: "+str(len(session.getLapTimes())))
 #    debugout (2, "Number of segments:" +str(len(session.getSegments())))
@@ -84,171 +161,207 @@ def analyze(session):
 #        textout(f'Session time: { session.getSessionInfo("sessionTime") }') 
 
 #    textout ("")
-#    if args.list_datapoints:
-#        textout('These datapoints are available:')
-#        for point in session.getDataPointsAvail():
-#            textout (f"- {point}")
-
 
     if args.laps:    
         debugout(1, "Generating lap times")
         textout("Lap times")
         textout("---------")
-        for count,lap in enumerate(session.getLapTimes()):
+        for count,lap in enumerate(summary.lapTimes):
             textout(f"Lap { count }: {math.trunc(lap/60):02}:{lap%60:0>6.3f}")
 
+    # The traces of each segment, fastest first, for the segment maps
+    segmentTraces = {}
+    if args.segments:
+        debugout(1, "Generating segment data")
+        for segment in range(1, len(session.waypoints)+1):
+            with profiling.stage("segment", segment=segment):
+                debugout(2, "Working on segment "+str(segment))
+                segmentNum = segment
+                traces = sorted(session.getSegmentsByTime(segmentNum), key=lambda x: x['time'])
+
+                # if this is the last segment and the fastest lap is the last lap, discard it because that's the in-segment
+                # and we want to see the actual fastest during-segment. The in-segment is likely to be the fastest simply because
+                # it's so much shorter, even if we are slower
+                if segmentNum == len(session.waypoints)+1 and session.numLaps == int(traces[0]["lap"]):
+                    del traces[0]
+
+                if len(traces[0]["path"]) == 0:
+                    debugout(1, "No map points in segment "+str(segmentNum))
+                    continue
+                segmentTraces[segmentNum] = traces
+
+                if not args.gps_only:
+                    # Work on fastest segment only (traces[0]) for brake/throttle maps
+                    fastest = traces[0]["path"]
+                    brakeZones = zones.getBrakeZones(fastest)
+                    throttleZones = zones.getThrottleZones(fastest)
+                    zoneList[segmentNum] = {"lap": traces[0]["lap"], "brake": brakeZones, "throttle": throttleZones}
+                    textout(f"Segment {segmentNum} brake zones (lap {traces[0]['lap']}):")
+                    for zone in brakeZones:
+                        textout(f"  on at {zone.startDistance:.0f} ft, released at {zone.stopDistance:.0f} ft, {zone.length:.0f} ft long, peak {zone.peak:.1f}")
+
+    if args.report:
+        writeReport(session, summary, records, segmentTraces, zoneList)
+
+# The segment map of every trace with the fastest in red, then the fastest trace's brake and throttle maps
+def addSegmentMaps(session, traces, segmentZones, imageJobs):
+    import mapRender
+    location = session.getMapLocation()
+    map = mapRender.MapSpec(location)
+    # The map is fitted to the second fastest trace below; simplify every trace for that zoom
+    boundingBox = session.getSeriesBoundaries(traces[1]["path"])
+    tolerance = args.simplify * mapRender.feetPerPixel(boundingBox, args.map_backend)
+
+    for trace in traces:
+        if args.verbose > 1:
+            print ("Trace length: "+str(len(trace["path"])))
+        mapPoints = trace["path"].simplifiedPositions(tolerance)
+        if 0 < len(mapPoints):
+            map.addPolyline(mapPoints, smoothFactor=0.0)
+        else:
+            print ("No mapPoints to plot!")
+
+    mapPoints = traces[0]["path"].simplifiedPositions(tolerance)
+    map.addPolyline(mapPoints, color="red", smoothFactor=0.0)
+    map.fitBounds(boundingBox)
+    imageJobs.append(("segmentMaps", True, ("map", map)))
+
+    if segmentZones is not None:
+        fastest = traces[0]["path"]
+        brakeMap = mapRender.MapSpec(session.getSeriesCenterpoint(fastest))
+        zones.addZonesToMap(brakeMap, segmentZones["brake"], zones.brakeColors)
+        brakeMap.fitBounds(session.getSeriesBoundaries(fastest))
+        imageJobs.append(("brakeMaps", True, ("map", brakeMap)))
+
+        throttleMap = mapRender.MapSpec(session.getSeriesCenterpoint(fastest))
+        zones.addZonesToMap(throttleMap, segmentZones["throttle"], zones.throttleColors)
+        throttleMap.fitBounds(session.getSeriesBoundaries(fastest))
+        imageJobs.append(("throttleMaps", True, ("map", throttleMap)))
+
+# The PDF report: maps, G-G plots and the results, through the template and pdfkit
+def writeReport(session, summary, records, segmentTraces, zoneList):
+    import mapRender
+    from jinja2 import Environment, FileSystemLoader
+    mapsList = {}
+    # TrackAddict files have no driver or session time - leave out what isn't there
+    outputFilename = '-'.join([part for part in [session.getSessionInfo("driverName"),
+                                                 session.getSessionInfo("trackName"),
+                                                 session.getSessionInfo("simpleDate"),
+                                                 session.getSessionInfo("sessionTime")] if part])
+    outputFilename = outputFilename.replace(" ", "-")
+    outputFilename = outputFilename.replace(",", "-")
+    outputFilename = outputFilename.replace(":", "-")
+    if os.path.exists(outputFilename+'.pdf'):
+        increment=1
+        while os.path.exists(outputFilename+"-"+str(increment)+'.pdf'):
+            increment+=1
+        outputFilename += '-'+str(increment)
+    outputFilename += '.pdf'
+
+    # Every image is described as a job here and rendered below, on a pool of worker processes with
+    # --render-jobs. Jobs are (mapsList key, whether the key holds a list of images, (kind, spec)).
+    imageJobs = []
+
     if args.combined_lap_map:
         debugout (1, "Generating combined lap map")
         boundingBox = session.getImageBoundaries()
         location = session.getMapLocation()
-        mapPoints = []
-        sessionMap = folium.Map(location=location, zoom_start=15, tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", attr="Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community")
-        sessionMap.fit_bounds(boundingBox)
+        sessionMap = mapRender.MapSpec(location)
+        sessionMap.fitBounds(boundingBox)
         debugout(1, "Adding combined lap map datapoints")
-        for lap in session.getLaps():
-            for measurement in lap:
-                mapPoints.append([measurement["GPSlat"], measurement["GPSlng"]])
-        folium.PolyLine(mapPoints).add_to(sessionMap)
-        debugout(1, "Generating image data")
-        imgData = sessionMap._to_png(3)
-        debugout(1, "Encoding in base64")
-        mapsList['combinedLapMap'] = base64.b64encode(imgData).decode("utf-8")
-        debugout(1, "Going to save PNG image")
-        if args.save_image_files:
-            filename = "combinedLapMap.png"
-            with open(filename, 'wb') as f:
-                f.write(imgData)
+        tolerance = args.simplify * mapRender.feetPerPixel(boundingBox, args.map_backend)
+        sessionMap.addPolyline(session.getActiveSlice().simplifiedPositions(tolerance))
+        imageJobs.append(("combinedLapMap", False, ("map", sessionMap)))
 
     if args.gg_maps:
         debugout(1, "Generating G-G map")
-        x = []
-        y = []
-        for lap in session.getLaps():
-            for measurement in lap:
-                x.append(measurement["lateralAccel"])
-                y.append(measurement["inlineAccel"])
-        plt.plot(np.array(x), np.array(y), '.k')
-        imgBuf = io.BytesIO()
-        plt.savefig(imgBuf, format='png')
-        imgBuf.seek(0)
-        mapsList["sessionGGMap"] = base64.b64encode(imgBuf.read()).decode("utf-8")
+        x = session.getChannel("lateralAccel")
+        y = session.getChannel("inlineAccel")
+        style = "density" if "auto" == args.gg_style else args.gg_style
+        imageJobs.append(("sessionGGMap", False, ("gg", (x, y, style))))
+
+    if args.lap_deltas:
+        debugout(1, "Generating lap comparison plot")
+        resampling = session.getLapResampling()
+        reference = session.getFastestLap()
+        laps = [idx for idx in range(1, len(resampling)-1) if idx != reference]
+        # Just the length of a hot lap - the out lap can run further
+        end = int(np.searchsorted(resampling.distance, resampling.referenceLength)) + 1
+        spec = (resampling.distance[:end],
+                resampling.getDeltaTimes(laps, reference)[:, :end],
+                resampling.getSpeeds(laps)[:, :end],
+                ["Lap "+str(idx) for idx in laps],
+                resampling.getSpeeds(reference)[:end],
+                "lap "+str(reference))
+        imageJobs.append(("lapDeltaPlot", False, ("delta", spec)))
 
     if args.individual_lap_maps:
         debugout(1, "Generating individual lap maps")
         boundingBox = session.getImageBoundaries()
         location = session.getMapLocation()
+        tolerance = args.simplify * mapRender.feetPerPixel(boundingBox, args.map_backend)
 
-        lapMaps = []
-        lapGGMaps = []
+        mapsList["individualLapMaps"] = []
+        mapsList["individualGGmaps"] = []
+        style = "points" if "auto" == args.gg_style else args.gg_style
         for lap in session.getLaps():
-            map = folium.Map(location=location, zoom_start=15, tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", attr="Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community")
-            map.fit_bounds(boundingBox)
-            mapPoints = []
-            x = []
-            y = []
-            for measurement in lap:
-                mapPoints.append([measurement["GPSlat"], measurement["GPSlng"]])
-                x.append(measurement["lateralAccel"])
-                y.append(measurement["inlineAccel"])
-            folium.PolyLine(mapPoints).add_to(map)
-            imgData = map._to_png(3)
-            lapMaps.append(base64.b64encode(imgData).decode("utf-8"))
-            plt.plot(np.array(x), np.array(y), '.k')
-            imgData = io.BytesIO()
-            plt.savefig(imgData, format='png')
-            imgData.seek(0)
-            lapGGMaps.append(base64.b64encode(imgData.read()).decode("utf-8"))
-        mapsList["individualLapMaps"] = lapMaps
-        mapsList["individualGGmaps"] = lapGGMaps
+            map = mapRender.MapSpec(location)
+            map.fitBounds(boundingBox)
+            map.addPolyline(lap.simplifiedPositions(tolerance))
+            imageJobs.append(("individualLapMaps", True, ("map", map)))
+            imageJobs.append(("individualGGmaps", True, ("gg", (lap["lateralAccel"], lap["inlineAccel"], style))))
 
     if args.segments:
         debugout(1, "Generating segment maps")
         # Generate individual segment traces, plot on different maps.
-        segmentMaps = []
-        brakeMaps = []
-        throttleMaps = []
-        location = session.getMapLocation()
-        for segment in range(1, len(session.waypoints)+1):
-            debugout(2, "Working on segment "+str(segment))
-            segmentNum = segment
-            traces = sorted(session.getSegmentsByTime(segmentNum), key=lambda x: x['time'])
-                
-            # if this is the last segment and the fastest lap is the last lap, discard it because that's the in-segment
-            # and we want to see the actual fastest during-segment. The in-segment is likely to be the fastest simply because
-            # it's so much shorter, even if we are slower
-            if segmentNum == len(session.waypoints)+1 and session.numLaps == int(traces[0]["lap"]):
-                del traces[0]
-
-            try:
-                map = folium.Map(location=location, zoom_start=15, tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", attr="Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community")
-            except Exception as e:
-                pprint.pprint(traces[0])
-                print(type(e))
-                print(e.args)
-                sys.exit(1)
-
-            for trace in traces:
-                mapPoints = []
-                if args.verbose > 1:
-                    print ("Trace length: "+str(len(trace)))
-                for pt in trace["path"]:
-                    mapPoints.append([pt["GPSlat"], pt["GPSlng"]])
-                if 0 < len(mapPoints):
-                    folium.PolyLine(mapPoints, smooth_factor=0.0).add_to(map)
-                else:
-                    print ("No mapPoints to plot!")
-
-            mapPoints = []
-            for pt in traces[0]["path"]:
-                mapPoints.append([pt["GPSlat"], pt["GPSlng"]])
-            if len(mapPoints) == 0:
-                debugout(1, "No map points in segment "+str(segmentNum))
-            else:
-                folium.PolyLine(mapPoints, color="red", smooth_factor=0.0).add_to(map)
-                map.fit_bounds(session.getSeriesBoundaries(traces[1]["path"]))
-                imgData = map._to_png(3)
-                segmentMaps.append(base64.b64encode(imgData).decode("utf-8"))
-
-                if not args.gps_only:
-                    # Work on fastest segment only (traces[0]) for brake/throttle maps
-                    brakeMap = folium.Map(location=session.getSeriesCenterpoint(traces[0]["path"]), zoom_start=15, tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", attr="Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community")
-                    for point in traces[0]["path"]:
-                        if point["brake"] > 0:
-                            folium.CircleMarker(location=[point["GPSlat"], point["GPSlng"]], radius=1, color="red").add_to(brakeMap)
-                    brakeMap.fit_bounds(session.getSeriesBoundaries(traces[0]["path"]))
-                    imgData = brakeMap._to_png(3)
-                    brakeMaps.append(base64.b64encode(imgData).decode("utf-8"))
-    
-                    throttleMap = folium.Map(location=session.getSeriesCenterpoint(traces[0]["path"]), zoom_start=15, tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", attr="Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community")
-                    for point in traces[0]["path"]:
-                        # Even at idle, there is some throttle positive position. This value may require adjustment.
-                        if point["throttle"] > 5:
-                            if point["throttle"] > 75:
-                                folium.CircleMarker(location=[point["GPSlat"], point["GPSlng"]], radius=1, color="orange").add_to(throttleMap)
-                            elif point["throttle"] > 35:
-                                folium.CircleMarker(location=[point["GPSlat"], point["GPSlng"]], radius=1, color="lightgreen").add_to(throttleMap)
-                            else:
-                                folium.CircleMarker(location=[point["GPSlat"], point["GPSlng"]], radius=1, color="green").add_to(throttleMap)
-                    throttleMap.fit_bounds(session.getSeriesBoundaries(traces[0]["path"]))
-                    imgData = throttleMap._to_png(3)
-                    throttleMaps.append(base64.b64encode(imgData).decode("utf-8"))
-    
-
-        mapsList["segmentMaps"] = segmentMaps
+        mapsList["segmentMaps"] = []
         if not args.gps_only:
-            mapsList["brakeMaps"] = brakeMaps
-            mapsList["throttleMaps"] = throttleMaps
-        
-
-    fileLoader = FileSystemLoader('templates')
-    env = Environment(loader=fileLoader)
-    env.filters['floataverage'] = utils.averageFilter
-    env.filters['stddev'] = utils.stdDevFilter
-    template = env.get_template('render.j2')
-    output = template.render(session=session, args=args, maps=mapsList)
+            mapsList["brakeMaps"] = []
+            mapsList["throttleMaps"] = []
+        for segmentNum, traces in segmentTraces.items():
+            addSegmentMaps(session, traces, zoneList.get(segmentNum), imageJobs)
+
+    # With the artifact cache, only the images whose inputs changed since an earlier run are rendered
+    jobs = [job for key, many, job in imageJobs]
+    def renderJobs(indexes):
+        debugout(1, "Rendering "+str(len(indexes))+" of "+str(len(jobs))+" images")
+        items = [(imageJobs[idx][0], jobs[idx]) for idx in indexes]
+        images = []
+        for imgData, records in utils.parallelMap(renderImageProfiled, items, args.render_jobs, initializer=setArgs, initargs=(args,)):
+            profiling.addRecords(records)
+            images.append(imgData)
+        return images
+    with profiling.stage("images", count=len(jobs)):
+        if args.artifact_cache:
+            cache = artifactCache.ArtifactCache(args.artifact_dir)
+            images = cache.getOrMake([getImageKey(job) for job in jobs], renderJobs)
+        else:
+            images = renderJobs(range(len(jobs)))
+    for (key, many, job), imgData in zip(imageJobs, images):
+        encoded = base64.b64encode(imgData).decode("utf-8")
+        if many:
+            mapsList[key].append(encoded)
+        else:
+            mapsList[key] = encoded
+        if "combinedLapMap" == key and args.save_image_files:
+            filename = "combinedLapMap.png"
+            with open(filename, 'wb') as f:
+                f.write(imgData)
+
+    with profiling.stage("template"):
+        fileLoader = FileSystemLoader('templates')
+        env = Environment(loader=fileLoader)
+        env.filters['floataverage'] = utils.averageFilter
+        env.filters['stddev'] = utils.stdDevFilter
+        template = env.get_template('render.j2')
+        output = template.render(session=session, summary=summary, args=args, maps=mapsList, zones=zoneList, records=records)
     if args.verbose:
         print ("Output size: "+str(len(output)))
-    file_content = from_string(output, False)
+    with profiling.stage("pdf"):
+        if args.artifact_cache:
+            file_content = cache.getOrMake([utils.makeKey("pdf", PDF_VERSION, output)], lambda missing: [from_string(output, False)])[0]
+        else:
+            file_content = from_string(output, False)
     if args.verbose:
         print ("File content length: "+str(len(file_content)))
     try:
@@ -272,23 +385,73 @@ def checkValidity(run):
 #      debugout(2, "Lap data points: "+str(len(lap)))
 
 
-def main():
-    runs = []
-    for file in args.file:
-        dataReader = getFileImporter(file)
-        runs.append(dataReader.readSessionData(args))
-        runs[-1].addSessionInfo(sourcefile = file)
-        runs[-1].trimEnds(args)
+# Import, trim and analyze one file. Each file is handled start to finish before the next one is
+# picked up, so only the sessions currently being worked on are held in memory.
+def processFile(file):
+    with profiling.stage("processFile", file=file):
+        processFileStages(file)
+
+# The channels in a file, from its header - nothing else is read
+def listDataPoints(file):
+    print(f"These datapoints are available in {file}:")
+    for point in getFileImporter(file).getChannelNames():
+        print(f"- {point}")
+
+def processFileStages(file):
+    if args.list_datapoints:
+        listDataPoints(file)
+        return
+    if args.cache:
+        cache = SessionCache(args.cache_dir)
+        run = cache.loadSession(file, args)
+    else:
+        run = loadSession(file, args)
+    debugout(1, "Checking run validity")
+    checkValidity(run)
+    records = None
+    if args.history:
+        with profiling.stage("history"):
+            store = HistoryStore(args.history_db)
+            store.addSession(file, args, True, run)
+            if run.getSessionInfo("trackId") is not None:
+                records = store.getTrackRecords(run.getSessionInfo("trackId"))
+                records["theoretical"] = trackAnalytics.loadAccumulator(store, run.getSessionInfo("trackId")).getTheoreticalBest(len(run.waypoints))
+            store.close()
+    debugout(1, "Analyzing run")
+    with profiling.stage("analyze", file=file):
+        analyze(run, records)
+    # Keep the significance of the traces just drawn for the next run's maps
+    if args.cache:
+        cache.update(file, args, run)
+
+# Worker process version of processFile - the output (and the profile records) are collected and handed
+# back so that it can be printed in file order instead of interleaved between workers.
+def processFileCaptured(file):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result, records = profiling.collect(processFile, file)
+    return output.getvalue(), records
+
+def main(argv=None):
+    setArgs(parser.parse_args(argv))
 
     # Prepare the output directory - create if necessary, clean up if necessary
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    for run in runs:
-        debugout(1, "Checking run validity")
-        checkValidity(run)
-        debugout(1, "Analyzing run")
-        analyze(run)
+    if args.profile:
+        profiling.enable(args.profile_memory)
+
+    if args.jobs > 1:
+        for output, records in utils.parallelMap(processFileCaptured, args.file, args.jobs, initializer=setArgs, initargs=(args,)):
+            print(output, end='')
+            profiling.addRecords(records)
+    else:
+        for file in args.file:
+            processFile(file)
+
+    if args.profile:
+        profiling.write(args.profile, args.profile_format)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# Content-addressed cache of report artifacts - map images, G-G plots and finished PDFs - so rerunning
+# a report with one option changed only renders what actually changed.
+#
+# An artifact's key is a hash of everything that goes into making it: the data it is drawn from (the
+# points on a map, the samples in a plot, the HTML of a report), the render parameters, and the version
+# of the renderer. Bump the renderer's version constant whenever its output changes for the same inputs.
+# Each artifact is a single file named after its key; keys are made with utils.makeKey().
+
+import os, os.path
+import tempfile
+
+defaultCacheDir = os.path.join(os.path.expanduser("~"), ".cache", "PyRDA", "artifacts")
+
+class ArtifactCache:
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir or defaultCacheDir
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def get(self, key):
+        try:
+            with open(self.getPath(key), "rb") as artifactFile:
+                return artifactFile.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        # Write under a temporary name and rename, so parallel workers never see half an artifact
+        fd, tempName = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as artifactFile:
+            artifactFile.write(data)
+        os.replace(tempName, self.getPath(key))
+
+    # The artifacts for keys, making the missing ones with makeMissing(list of indexes into keys) ->
+    # list of artifacts, which are then stored
+    def getOrMake(self, keys, makeMissing):
+        artifacts = [self.get(key) for key in keys]
+        missing = [idx for idx, artifact in enumerate(artifacts) if artifact is None]
+        if 0 < len(missing):
+            for idx, artifact in zip(missing, makeMissing(missing)):
+                self.put(keys[idx], artifact)
+                artifacts[idx] = artifact
+        return artifacts
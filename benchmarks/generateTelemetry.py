@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# Synthetic telemetry for the tracks in tracks/, written as AiM or TrackAddict CSV files.
+#
+# The car drives out of the paddock onto the track at enterTrackPoint, does the requested number of
+# laps through the sector ends, and on the in lap leaves the track at exitTrackPoint for the paddock.
+# The driven line is a centripetal Catmull-Rom spline through those points, so it passes through every
+# waypoint the lap detection looks for. Speed comes from the line's curvature (cornering grip), limited
+# by acceleration and braking, and varies a little from lap to lap; the other channels (throttle,
+# brake, steering, lateral and inline acceleration, heading) are derived from the speed and the line.
+# GPS positions get a little noise. Everything is reproducible from the seed.
+#
+# Usage: generateTelemetry.py -t VIRfull -o vir.csv [--format aim|trackaddict] [--laps N] [--rate HZ]
+#                             [--extra-channels N] [--seed N]
+
+import os, os.path, sys
+import argparse
+import importlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+G = 32.174              # ft/s^2
+maxSpeed = 205.0        # ft/s, about 140 mph
+cornerGrip = 1.05       # g
+accelerationLimit = 0.45
+brakingLimit = 1.1
+pitSpeed = 30.0         # paddock and pit lane, ft/s
+inLapSpeed = 90.0       # cooling down on the in lap
+splineStep = 2.0        # ft between points of the driven line
+gpsNoise = 1.0          # ft
+wheelbase = 7.6         # ft
+steeringRatio = 15.0
+
+# Driving phases, for the speed limits
+PADDOCK, OUTLAP, HOTLAP, INLAP = range(4)
+
+def loadTrack(trackName):
+    return importlib.import_module("tracks."+trackName)
+
+# Points along a centripetal Catmull-Rom spline through the control points (an N x 2 array), about
+# step apart. Returns the points and, for each, the index of the control segment it lies on.
+def catmullRom(controls, step):
+    padded = np.vstack((2*controls[0] - controls[1], controls, 2*controls[-1] - controls[-2]))
+    points = []
+    segments = []
+    for i in range(len(controls)-1):
+        p0, p1, p2, p3 = padded[i:i+4]
+        t1 = np.hypot(*(p1-p0))**0.5 + 1e-9
+        t2 = t1 + np.hypot(*(p2-p1))**0.5 + 1e-9
+        t3 = t2 + np.hypot(*(p3-p2))**0.5 + 1e-9
+        count = max(2, int(np.hypot(*(p2-p1)) / step))
+        t = np.linspace(t1, t2, count, endpoint=False)[:, None]
+        a1 = (t1-t)/t1*p0 + t/t1*p1
+        a2 = (t2-t)/(t2-t1)*p1 + (t-t1)/(t2-t1)*p2
+        a3 = (t3-t)/(t3-t2)*p2 + (t-t2)/(t3-t2)*p3
+        b1 = (t2-t)/t2*a1 + t/t2*a2
+        b2 = (t3-t)/(t3-t1)*a2 + (t-t1)/(t3-t1)*a3
+        points.append((t2-t)/(t2-t1)*b1 + (t-t1)/(t2-t1)*b2)
+        segments.append(np.full(count, i))
+    points.append(controls[-1:])
+    segments.append([len(controls)-2])
+    return np.vstack(points), np.concatenate(segments)
+
+# Where exitTrackPoint sits on the lap: the index of the sector end the in lap turns off after
+def getExitIndex(loopXY, exitXY):
+    best, bestDistance = 0, np.inf
+    for j in range(1, len(loopXY)):
+        a, b = loopXY[j-1], loopXY[j]
+        ab = b - a
+        t = np.clip(np.dot(exitXY - a, ab) / max(np.dot(ab, ab), 1e-9), 0, 1)
+        distance = np.hypot(*(a + t*ab - exitXY))
+        if distance < bestDistance:
+            best, bestDistance = j-1, distance
+    return best
+
+# The control points of the whole session in local feet, with each control segment's phase and lap
+def getRoute(track, laps):
+    project = lambda points: utils.projectLocal(points, track.startpoint)
+    loopXY = project(track.sectorEnds)
+    enterXY = project([track.enterTrackPoint])[0]
+    exitXY = project([track.exitTrackPoint])[0]
+
+    # Approach enterTrackPoint from the paddock, roughly along the track's direction there
+    direction = loopXY[0] - enterXY
+    direction = direction / max(np.hypot(*direction), 1e-9)
+    side = np.array([-direction[1], direction[0]])
+    controls = [enterXY - 600*direction + 300*side, enterXY - 250*direction + 60*side, enterXY]
+    phases = [PADDOCK, OUTLAP]
+    lapNumbers = [0, 0]
+    # The out lap runs from enterTrackPoint to the first start/finish crossing
+    for lap in range(laps+1):
+        for point in loopXY:
+            controls.append(point)
+            phases.append(OUTLAP if 0 == lap else HOTLAP)
+            lapNumbers.append(lap)
+    exitIndex = getExitIndex(loopXY, exitXY)
+    for point in loopXY[:exitIndex+1]:
+        controls.append(point)
+        phases.append(INLAP)
+        lapNumbers.append(laps+1)
+    controls += [exitXY, exitXY + 250*side, exitXY + 600*side + 300*direction]
+    phases += [INLAP, PADDOCK, PADDOCK]
+    lapNumbers += [laps+1, laps+1, laps+1]
+    return np.array(controls), np.array(phases), np.array(lapNumbers)
+
+# Signed curvature (1/ft) along a line
+def getCurvature(xy):
+    heading = np.unwrap(np.arctan2(np.gradient(xy[:, 1]), np.gradient(xy[:, 0])))
+    ds = np.hypot(*np.gradient(xy, axis=0).T)
+    return np.gradient(heading) / np.maximum(ds, 1e-6), heading
+
+# Fastest speed along the line within grip, acceleration and braking limits
+def getSpeedProfile(ds, curvature, caps, grip):
+    limit = np.minimum(caps, np.sqrt(cornerGrip*grip*G / np.maximum(np.abs(curvature), 1e-6)))
+    speed = limit.copy()
+    for i in range(1, len(speed)):
+        speed[i] = min(speed[i], np.sqrt(speed[i-1]**2 + 2*accelerationLimit*G*ds[i]))
+    for i in range(len(speed)-2, -1, -1):
+        speed[i] = min(speed[i], np.sqrt(speed[i+1]**2 + 2*brakingLimit*G*ds[i+1]))
+    return np.maximum(speed, 3.0)
+
+def generate(trackName, laps=10, rate=20.0, extraChannels=0, seed=1):
+    track = loadTrack(trackName)
+    rng = np.random.default_rng(seed)
+    controls, phases, lapNumbers = getRoute(track, laps)
+    xy, segmentIdx = catmullRom(controls, splineStep)
+    phase = phases[np.minimum(segmentIdx, len(phases)-1)]
+    lap = lapNumbers[np.minimum(segmentIdx, len(lapNumbers)-1)]
+
+    # A slightly different line and pace every lap
+    lapGrip = rng.uniform(0.93, 1.0, laps+2)
+    lapOffset = rng.uniform(-4, 4, (laps+2, 2))
+    xy = xy + lapOffset[lap] * (phase == HOTLAP)[:, None]
+    caps = np.choose(phase, [pitSpeed, maxSpeed*0.8, maxSpeed, inLapSpeed])
+
+    ds = np.concatenate(([0.0], np.hypot(*np.diff(xy, axis=0).T)))
+    curvature, heading = getCurvature(xy)
+    speed = getSpeedProfile(ds, curvature, caps, lapGrip[lap])
+
+    # Time at each point of the line, then resample at the logger's rate
+    elapsed = np.concatenate(([0.0], np.cumsum(2*ds[1:] / (speed[1:] + speed[:-1]))))
+    times = np.arange(0, elapsed[-1], 1.0/rate)
+    sample = lambda values: np.interp(times, elapsed, values)
+    sampleSpeed = sample(speed)
+    inline = np.gradient(sampleSpeed, times) / G
+    lateral = sample(speed**2 * curvature) / G
+
+    positions = utils.unprojectLocal(np.column_stack((sample(xy[:, 0]), sample(xy[:, 1]))) + rng.normal(0, gpsNoise, (len(times), 2)), track.startpoint)
+    channels = {
+        "time": times,
+        "speed": sampleSpeed * 0.681818,
+        "lat": positions[:, 0],
+        "lng": positions[:, 1],
+        "heading": np.mod(90 - np.degrees(sample(heading)), 360),
+        "throttle": np.clip(np.where(inline > -0.05, 15 + 85*np.clip(inline/accelerationLimit, 0, 1) + 85*(sampleSpeed >= maxSpeed*0.98), 0), 0, 100),
+        "brake": np.clip(-inline - 0.1, 0, None) * 55,
+        "steer": np.degrees(np.arctan(wheelbase * sample(curvature))) * steeringRatio,
+        "lateral": lateral + rng.normal(0, 0.03, len(times)),
+        "inline": inline + rng.normal(0, 0.03, len(times)),
+    }
+    # Sensor noise on the pressure while the brake is on
+    channels["brake"] += (channels["brake"] > 0) * np.abs(rng.normal(0, 0.5, len(times)))
+    extras = [np.cumsum(rng.normal(0, 1, len(times))) for i in range(extraChannels)]
+    return channels, extras
+
+aimChannels = [("Time", "s", "time"), ("GPS Speed", "mph", "speed"), ("GPS Latitude", "deg", "lat"), ("GPS Longitude", "deg", "lng"),
+               ("GPS Heading", "deg", "heading"), ("PPS", "%", "throttle"), ("BrakePress", "bar", "brake"),
+               ("SteerAngle", "deg", "steer"), ("LateralAcc", "g", "lateral"), ("InlineAcc", "g", "inline")]
+trackAddictChannels = [("Time", "time"), ("UTC Time", "utc"), ("Latitude", "lat"), ("Longitude", "lng"), ("Speed (MPH)", "speed"),
+                       ("Heading", "heading"), ("Accelerator Pedal (%) *OBD", "throttle"), ("Brake (calculated)", "brake"),
+                       ("Accel X", "lateral"), ("Accel Y", "inline")]
+# 2023-03-04 15:15 UTC, the AiM files' session start
+trackAddictStart = 1677942900.0
+
+def writeRows(outFile, columns, quote):
+    rowFormat = ','.join(['"%.7f"' if quote else '%.7f'] * len(columns)) + '\n'
+    for row in np.column_stack(columns).tolist():
+        outFile.write(rowFormat % tuple(row))
+
+def writeAiM(filename, track, channels, extras, rate):
+    headers = [name for name, unit, key in aimChannels] + ["Extra%d" % (i+1) for i in range(len(extras))]
+    units = [unit for name, unit, key in aimChannels] + ["u"] * len(extras)
+    metadata = [("Format", "AiM CSV File"), ("Session", track.description), ("Vehicle", "Miata"), ("Racer", "Test Driver"),
+                ("Championship", ""), ("Comment", "synthetic"), ("Date", "Saturday, March 4, 2023"), ("Time", "10:15 AM"),
+                ("Sample Rate", "%g" % rate), ("Duration", "%.3f" % channels["time"][-1]), ("Segment", "Session"),
+                ("Beacon Markers", ""), ("Segment Times", "")]
+    with open(filename, "w") as outFile:
+        for key, value in metadata:
+            outFile.write('"%s","%s"\n' % (key, value))
+        outFile.write('\n')
+        outFile.write(','.join('"%s"' % h for h in headers) + '\n')
+        outFile.write(','.join('"%s"' % u for u in units) + '\n')
+        outFile.write(','.join('"%d"' % i for i in range(len(headers))) + '\n')
+        writeRows(outFile, [channels[key] for name, unit, key in aimChannels] + extras, True)
+
+def writeTrackAddict(filename, track, channels, extras, rate):
+    headers = [name for name, key in trackAddictChannels] + ["Extra%d" % (i+1) for i in range(len(extras))]
+    channels = dict(channels, utc=channels["time"] + trackAddictStart)
+    with open(filename, "w") as outFile:
+        # As TrackAddict writes them: a few comment rows, then the quoted data headers
+        outFile.write("# RaceRender Data: TrackAddict 4.6.1 on Android 13 [Pixel 6] (Mode: 0)\n")
+        outFile.write("# Vehicle: Miata\n")
+        outFile.write("# Comment: synthetic session for %s, %g Hz\n" % (track.description, rate))
+        outFile.write(','.join('"%s"' % h for h in headers) + '\n')
+        writeRows(outFile, [channels[key] for name, key in trackAddictChannels] + extras, False)
+
+# Write a synthetic session file; returns the number of samples
+def writeSession(filename, trackName, fileFormat="aim", laps=10, rate=20.0, extraChannels=0, seed=1):
+    channels, extras = generate(trackName, laps, rate, extraChannels, seed)
+    if "aim" == fileFormat:
+        writeAiM(filename, loadTrack(trackName), channels, extras, rate)
+    elif "trackaddict" == fileFormat:
+        writeTrackAddict(filename, loadTrack(trackName), channels, extras, rate)
+    else:
+        raise ValueError("Unknown file format: "+str(fileFormat))
+    return len(channels["time"])
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic track session data file')
+    parser.add_argument('-t', '--track', default='VIRfull', help='Track module in tracks/ (default: %(default)s)')
+    parser.add_argument('-o', '--output', required=True, help='File to write')
+    parser.add_argument('--format', choices=['aim', 'trackaddict'], default='aim')
+    parser.add_argument('--laps', type=int, default=10, help='Hot laps, between the out lap and the in lap')
+    parser.add_argument('--rate', type=float, default=20.0, help='Samples per second')
+    parser.add_argument('--extra-channels', type=int, default=0, help='Additional (random) channels, for wide files')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    count = writeSession(args.output, args.track, args.format, args.laps, args.rate, args.extra_channels, args.seed)
+    print("Wrote %d samples to %s" % (count, args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+# Times each stage of the pipeline on synthetic sessions from generateTelemetry.py and compares the
+# results with the recorded baselines in baselines.json.
+#
+# Stages:
+#   import          - the importer's readSessionData(): parse, track lookup and lap detection
+#   addMeasurement  - the same samples added one at a time with addMeasurement(), then flush()
+#   lapDetection    - assignLapsAndSegments() on the loaded channels
+#   trimEnds        - trimEnds() on the lap-detected session
+#   summary         - the lap and segment summary (SessionSummary), built from scratch
+#   segmentsByTime  - getSegmentsByTime() for every segment, with a fresh segment index
+#   analyze         - analyzeSession.analyze() with segment and G-G maps, rendered with the local map
+#                     backend and without the PDF step, so it runs offline and without wkhtmltopdf
+#
+# Every stage runs --repeat times on its own copy of the session and the fastest run is kept.
+#
+# Usage: runBenchmarks.py                     run every scenario and show the times next to the baselines
+#        runBenchmarks.py --check             exit with status 1 if a stage is slower than its baseline
+#                                             by more than --tolerance times
+#        runBenchmarks.py --record            save the times as the new baselines
+#        runBenchmarks.py --scenario NAME     only run the named scenario (can be given more than once)
+#        runBenchmarks.py --track Sebring --laps 40 --rate 100 --channels 20 [--format trackaddict]
+#                                             time an ad-hoc session instead of the scenarios
+
+import os, os.path, sys
+import argparse
+import copy
+import json
+import platform
+import shutil
+import tempfile
+import time
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchmarkDir)
+sys.path.insert(0, repoDir)
+sys.path.insert(0, benchmarkDir)
+
+import numpy as np
+import generateTelemetry
+from dataImporter import getFileImporter
+from datamodel import TrackSession
+
+baselinesFile = os.path.join(benchmarkDir, "baselines.json")
+
+# name: (track, file format, hot laps, samples per second, extra channels)
+scenarios = {
+    "aim-vir-10laps-20hz": ("VIRfull", "aim", 10, 20.0, 0),
+    "aim-sebring-30laps-50hz": ("Sebring", "aim", 30, 50.0, 0),
+    "aim-roebling-5laps-20hz-wide": ("Roebling", "aim", 5, 20.0, 50),
+    "trackaddict-vir-10laps-25hz": ("VIRfull", "trackaddict", 10, 25.0, 0),
+}
+
+stages = ["import", "addMeasurement", "lapDetection", "trimEnds", "summary", "segmentsByTime", "analyze"]
+
+parser = argparse.ArgumentParser(description='Time the analysis pipeline on synthetic sessions')
+parser.add_argument('--scenario', action='append', choices=sorted(scenarios.keys()), help='Scenario to run (default: all)')
+parser.add_argument('--stage', action='append', choices=stages, help='Stage to time (default: all)')
+parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage; the fastest counts')
+parser.add_argument('--record', action='store_true', help='Save the times as the new baselines')
+parser.add_argument('--check', action='store_true', help='Fail if a stage is slower than its baseline by more than --tolerance times')
+parser.add_argument('--tolerance', type=float, default=1.5, help='Allowed slowdown factor for --check')
+parser.add_argument('--keep-data', action='store', help='Write the generated files to this directory and keep them')
+parser.add_argument('--track', action='store', help='Time an ad-hoc session on this track instead of the scenarios')
+parser.add_argument('--format', choices=['aim', 'trackaddict'], default='aim', help='File format of the ad-hoc session')
+parser.add_argument('--laps', type=int, default=10, help='Hot laps in the ad-hoc session')
+parser.add_argument('--rate', type=float, default=20.0, help='Samples per second in the ad-hoc session')
+parser.add_argument('--channels', type=int, default=0, help='Extra channels in the ad-hoc session')
+
+# What the pipeline stages are given as their args - the options analyzeSession would pass
+def getPipelineArgs():
+    return argparse.Namespace(verbose=0, trackname=None, gps_only=False, no_trim_tail=False, segments=True, gg_maps=True)
+
+# analyzeSession, set up with the options of the report being timed
+analyzeModule = None
+def getAnalyzeModule(outputDir):
+    global analyzeModule
+    if analyzeModule is None:
+        import analyzeSession
+        analyzeSession.setArgs(analyzeSession.parser.parse_args(["-f", "benchmark", "--map-backend", "local", "--segments",
+                                                                 "--gg-maps", "--no-cache", "--no-artifact-cache", "--no-history"]))
+        # The HTML is the end of the report as far as the benchmark is concerned
+        analyzeSession.from_string = lambda html, path: html.encode()
+        # As checkValidity() leaves it
+        analyzeSession.args.verbose = 0
+        analyzeModule = analyzeSession
+    analyzeModule.outputDir = outputDir
+    return analyzeModule
+
+def importSession(filename):
+    return getFileImporter(filename).readSessionData(getPipelineArgs())
+
+# Each stage is a (setup, run) pair: setup() makes whatever run(state) works on, outside the timing
+def getStages(filename, outputDir):
+    pipelineArgs = getPipelineArgs()
+    loaded = importSession(filename)
+    trimmed = copy.deepcopy(loaded)
+    trimmed.trimEnds(pipelineArgs)
+    for session in (loaded, trimmed):
+        session.addSessionInfo(sourcefile = filename)
+    names = [k for k in loaded.channels.keys() if k not in ("time", "lap", "segment")]
+    rows = list(zip(*[loaded.channels[k].tolist() for k in ["time"] + names]))
+
+    def addMeasurements(state):
+        session = TrackSession()
+        for row in rows:
+            session.addMeasurement(row[0], **dict(zip(names, row[1:])))
+        session.flush()
+
+    def freshSession(session):
+        def setup():
+            fresh = copy.deepcopy(session)
+            fresh.invalidateIndexes()
+            fresh.traceSignificance = {}
+            return fresh
+        return setup
+
+    def segmentsByTime(session):
+        for segNum in range(1, len(session.waypoints)+2):
+            session.getSegmentsByTime(segNum)
+
+    def analyze(session):
+        getAnalyzeModule(outputDir).analyze(session)
+
+    return {
+        "import": (lambda: None, lambda state: importSession(filename)),
+        "addMeasurement": (lambda: None, addMeasurements),
+        "lapDetection": (freshSession(loaded), lambda session: session.assignLapsAndSegments(pipelineArgs)),
+        "trimEnds": (freshSession(loaded), lambda session: session.trimEnds(pipelineArgs)),
+        "summary": (freshSession(trimmed), lambda session: session.getSummary()),
+        "segmentsByTime": (freshSession(trimmed), segmentsByTime),
+        "analyze": (freshSession(trimmed), analyze),
+    }
+
+def timeStage(setup, run, repeat):
+    best = None
+    for count in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def runScenario(name, spec, dataDir, outputDir, wanted, repeat):
+    trackName, fileFormat, laps, rate, extraChannels = spec
+    filename = os.path.join(dataDir, name+".csv")
+    numSamples = generateTelemetry.writeSession(filename, trackName, fileFormat, laps, rate, extraChannels)
+    print(f"{name}: {numSamples} samples, {os.path.getsize(filename)/1e6:.1f} MB")
+    times = {}
+    for stage, (setup, run) in getStages(filename, outputDir).items():
+        if stage in wanted:
+            times[stage] = round(timeStage(setup, run, repeat), 6)
+    return {"samples": numSamples, "stages": times}
+
+def getMachine():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+def loadBaselines():
+    if not os.path.exists(baselinesFile):
+        return {"machine": None, "scenarios": {}}
+    with open(baselinesFile) as baselines:
+        return json.load(baselines)
+
+# Prints the times against the baselines, and returns the stages that are too slow
+def report(results, baselines, tolerance):
+    regressions = []
+    print()
+    print(f"{'scenario':<32}{'stage':<16}{'seconds':>10}{'baseline':>10}{'ratio':>8}")
+    for name, result in results.items():
+        recorded = baselines["scenarios"].get(name, {}).get("stages", {})
+        for stage, seconds in result["stages"].items():
+            line = f"{name:<32}{stage:<16}{seconds:>10.4f}"
+            if stage in recorded:
+                ratio = seconds / recorded[stage]
+                line += f"{recorded[stage]:>10.4f}{ratio:>8.2f}"
+                if ratio > tolerance:
+                    line += "  SLOWER"
+                    regressions.append((name, stage, ratio))
+            print(line)
+    return regressions
+
+def main():
+    options = parser.parse_args()
+    wanted = options.stage or stages
+    if options.track:
+        selected = {"adhoc": (options.track, options.format, options.laps, options.rate, options.channels)}
+    else:
+        selected = {name: scenarios[name] for name in (options.scenario or scenarios.keys())}
+
+    workDir = tempfile.mkdtemp(prefix="pyrda-bench-")
+    dataDir = options.keep_data or workDir
+    os.makedirs(dataDir, exist_ok=True)
+    outputDir = os.path.join(workDir, "output")
+    os.makedirs(outputDir)
+    # analyze() finds its templates relative to the working directory
+    savedDir = os.getcwd()
+    os.chdir(repoDir)
+    try:
+        results = {name: runScenario(name, spec, dataDir, outputDir, wanted, options.repeat) for name, spec in selected.items()}
+    finally:
+        os.chdir(savedDir)
+        shutil.rmtree(workDir)
+
+    baselines = loadBaselines()
+    regressions = report(results, baselines, options.tolerance)
+    if baselines["machine"] and baselines["machine"] != getMachine():
+        print()
+        print("Note: the baselines were recorded on a different machine: "+json.dumps(baselines["machine"]))
+
+    if options.record:
+        if options.track:
+            print("Ad-hoc sessions are not recorded as baselines.")
+        else:
+            baselines["machine"] = getMachine()
+            for name, result in results.items():
+                baselines["scenarios"].setdefault(name, {"samples": result["samples"], "stages": {}})
+                baselines["scenarios"][name]["samples"] = result["samples"]
+                baselines["scenarios"][name]["stages"].update(result["stages"])
+            with open(baselinesFile, "w") as baselinesOut:
+                json.dump(baselines, baselinesOut, indent=2, sort_keys=True)
+                baselinesOut.write("\n")
+            print("Baselines saved to "+baselinesFile)
+
+    if options.check and regressions:
+        print()
+        for name, stage, ratio in regressions:
+            print(f"{name} {stage}: {ratio:.2f} times the baseline")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
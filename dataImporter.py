@@ -3,8 +3,16 @@
 # Class for data importation
 import os.path
 import csv
+from array import array
+from operator import itemgetter
 from datamodel import TrackSession
+import numpy as np
 import pprint
+import profiling
+
+# Bump whenever a change to the importers or to lap detection changes the sessions they produce -
+# it is part of the session cache key.
+IMPORTER_VERSION = 3
 
 def getFileImporter(filename):
     if not os.path.isfile(filename):
@@ -13,14 +21,80 @@ def getFileImporter(filename):
     with open(filename, "r") as sourceFile:
         line = sourceFile.readline()
         sourceFile.close()
-    if "AiM CSV File" in line:
+    return getImporterFor(line, filename)
+
+# The importer for a file, from its first line
+def getImporterFor(firstLine, filename):
+    if "AiM CSV File" in firstLine:
         return AiMImporter(filename)
-    elif "RaceRender Data: TrackAddict" in line: 
+    elif "RaceRender Data: TrackAddict" in firstLine:
         return TrackAddictImporter(filename)
     else:
         return False
 
+# Import one data file into a TrackSession ready for analysis: lap detection done, the source file
+# recorded and, optionally, the paddock ends trimmed off.
+def loadSession(filename, args, trim=True):
+    with profiling.stage("readSessionData", file=filename):
+        dataReader = getFileImporter(filename)
+        session = dataReader.readSessionData(args)
+    session.addSessionInfo(sourcefile = filename)
+    if trim:
+        with profiling.stage("trimEnds", file=filename):
+            session.trimEnds(args)
+    return session
+
+# The session channels the enabled analyses read. Lap detection, trimming, lap and segment times, the
+# maps and the lap comparisons only need the time and position; the G-G plots add the accelerations
+# and the segment brake and throttle zones the pedals. Scripts without these options (updateSpreadsheet,
+# liveSession) get the time and position alone.
+def getNeededChannels(args):
+    channels = {"time", "GPSlat", "GPSlng"}
+    if getattr(args, "gg_maps", False) or getattr(args, "individual_lap_maps", False):
+        channels.update(("lateralAccel", "inlineAccel"))
+    if getattr(args, "segments", False) and not args.gps_only:
+        channels.update(("brake", "throttle"))
+    return channels
+
+# Stream the data rows from a csv reader straight into one typed buffer per channel.
+# columns is a list of (channel name, column index) pairs, resolved once from the header row, so
+# each row costs one itemgetter call and the float conversions - nothing else is kept per row.
+def readChannelColumns(reader, columns, skipComments=False):
+    getter = itemgetter(*[idx for name, idx in columns])
+    buffers = [array('d') for name, idx in columns]
+    appenders = [buf.append for buf in buffers]
+    for row in reader:
+        if 0 == len(row):
+            continue
+        if skipComments and row[0].startswith('#'):
+            continue
+        values = getter(row)
+        if 1 == len(columns):
+            values = (values,)
+        for append, value in zip(appenders, values):
+            append(float(value))
+    return {name: np.frombuffer(buf, dtype=np.float64) for (name, idx), buf in zip(columns, buffers)}
+
+# Decode just the given columns of the rest of an open data file into one array per channel, with
+# NumPy's C CSV parser - the other fields of a row are skipped over, never converted or kept. NumPy
+# before 1.23 can't parse quoted fields, and gets readChannelColumns() instead.
+def loadChannelColumns(fileHandle, columns, skipComments=False):
+    try:
+        data = np.loadtxt(fileHandle, dtype=np.float64, delimiter=',', quotechar='"', comments='#' if skipComments else None,
+                          usecols=[idx for name, idx in columns], ndmin=2)
+    except TypeError:
+        return readChannelColumns(csv.reader(fileHandle), columns, skipComments)
+    return {name: np.ascontiguousarray(data[:, i]) for i, (name, idx) in enumerate(columns)}
+
 class AiMImporter():
+    # Rows before the first sample: metadata, a blank row, headers, units and one more
+    headerRows = 17
+    skipComments = False
+
+    # Whether lines, the start of the file, hold everything that comes before the first sample
+    def isHeaderComplete(self, lines):
+        return len(lines) == self.headerRows
+
     def __init__(self, filename):
         self.session = TrackSession()
         self.dataFile = filename
@@ -29,72 +103,72 @@ class AiMImporter():
             "GPSlat":"GPS Latitude",
             "GPSlng":"GPS Longitude",
             "throttle":"PPS",
-            "brake":"BrakePress", 
+            "brake":"BrakePress",
             "heading":"GPS Heading",
             "steer":"SteerAngle",
             "lateralAccel":"LateralAcc",
             "inlineAccel":"InlineAcc"
         }
 
-    def readSessionData(self, args):
-        unparsedData = []
+    # The first 13 rows are "name","value" metadata pairs, followed by a blank row
+    def readMetadata(self, reader):
+        metadata = [next(reader) for i in range(13)]
+        self.session.addSessionInfo(trackName = metadata[1][1])
+        self.session.addSessionInfo(sessionDate = metadata[6][1])
+        self.session.addSessionInfo(sessionTime = metadata[7][1])
+        self.session.addSessionInfo(vehicle = metadata[2][1])
+        self.session.addSessionInfo(driverName = metadata[3][1])
+        assert 0 == len(next(reader))
+
+    # Next come the column headers, the units and one more row before the actual session data
+    def readColumnHeaders(self, reader):
+        columnHeaders = next(reader)
+        units = next(reader)
+        next(reader)
+        return columnHeaders
+
+    # (channel, column) for each channel the analyses need, time first
+    def getChannelColumns(self, columnHeaders, args):
+        wanted = getNeededChannels(args)
+        return [(k, columnHeaders.index(v)) for k, v in self.dataLogPoints.items() if k in wanted]
+
+    # The channels in the file, from the header alone - no samples are read
+    def getChannelNames(self):
+        with open(self.dataFile, "r", newline='') as fileHandle:
+            reader = csv.reader(fileHandle)
+            self.readMetadata(reader)
+            return self.readColumnHeaders(reader)
 
-        with open(self.dataFile, "r") as fileHandle:
+    def readSessionData(self, args):
+        with open(self.dataFile, "r", newline='') as fileHandle:
             reader = csv.reader(fileHandle)
-            for row in reader:
-                unparsedData.append(row)
-
-        # Parse through the in-memory array for metadata
-        self.session.addSessionInfo(trackName = unparsedData[1][1])
-        self.session.addSessionInfo(sessionDate = unparsedData[6][1])
-        self.session.addSessionInfo(sessionTime = unparsedData[7][1])
-        self.session.addSessionInfo(vehicle = unparsedData[2][1])
-        self.session.addSessionInfo(driverName = unparsedData[3][1])
-        
-        if args.trackname:
-            self.session.addSessionInfo(trackName = args.trackname)
-            
-        self.session.loadTrack(args)
-
-        # remove the metadata from the in-memory array
-        for i in range(13):
-            del unparsedData[0]
-
-        assert 0 == len(unparsedData[0])
-        del unparsedData[0]
-        # first array entry right now is data headers
-        columnHeaders = unparsedData[0]
-        units = unparsedData[1]
-        # delete the headers and blank line, trim to only the actual session data
-        del unparsedData[0]
-        del unparsedData[0]
-        del unparsedData[0]
-
-        # Process all datapoints
-        for row in unparsedData:
-            if args.gps_only:
-                self.session.addMeasurement(row[columnHeaders.index(self.dataLogPoints["time"])],
-                    GPSlat = float(row[columnHeaders.index(self.dataLogPoints["GPSlat"])]),
-                    GPSlng = float(row[columnHeaders.index(self.dataLogPoints["GPSlng"])]),
-                    heading = float(row[columnHeaders.index(self.dataLogPoints["heading"])]),
-                    lateralAccel = float(row[columnHeaders.index(self.dataLogPoints["lateralAccel"])]),
-                    inlineAccel = float(row[columnHeaders.index(self.dataLogPoints["inlineAccel"])])
-                )
-            else:
-                self.session.addMeasurement(row[columnHeaders.index(self.dataLogPoints["time"])],
-                    GPSlat = float(row[columnHeaders.index(self.dataLogPoints["GPSlat"])]),
-                    GPSlng = float(row[columnHeaders.index(self.dataLogPoints["GPSlng"])]),
-                    throttle = float(row[columnHeaders.index(self.dataLogPoints["throttle"])]),
-                    brake = float(row[columnHeaders.index(self.dataLogPoints["brake"])]),
-                    heading = float(row[columnHeaders.index(self.dataLogPoints["heading"])]),
-                    steer = float(row[columnHeaders.index(self.dataLogPoints["steer"])]),
-                    lateralAccel = float(row[columnHeaders.index(self.dataLogPoints["lateralAccel"])]),
-                    inlineAccel = float(row[columnHeaders.index(self.dataLogPoints["inlineAccel"])])
-                )
-                
+            self.readMetadata(reader)
+
+            if args.trackname:
+                self.session.addSessionInfo(trackName = args.trackname)
+
+            self.session.loadTrack(args)
+
+            columnHeaders = self.readColumnHeaders(reader)
+            columns = self.getChannelColumns(columnHeaders, args)
+            with profiling.stage("parse"):
+                self.session.setChannels(loadChannelColumns(fileHandle, columns, skipComments=self.skipComments))
+
+        # A track name the registry doesn't know - try where the session was driven instead
+        if self.session.track is None:
+            self.session.matchTrack(args)
+        with profiling.stage("lapDetection"):
+            self.session.assignLapsAndSegments(args)
         return self.session
 
 class TrackAddictImporter():
+    # The file starts with comment rows (the app and version, then whatever metadata the app wrote) and
+    # the data headers are the first row that isn't one. Comment rows can appear among the samples too.
+    skipComments = True
+
+    def isHeaderComplete(self, lines):
+        return 0 < len(lines[-1].strip()) and not lines[-1].startswith('#')
+
     def __init__(self, filename):
         self.session = TrackSession()
         self.dataFile = filename
@@ -109,39 +183,45 @@ class TrackAddictImporter():
             "inlineAccel":"Accel Y"
         }
 
-    def readSessionData(self):
-        unparsedData = []
+    # skip the metadata rows; the next row is the data headers
+    def readColumnHeaders(self, reader):
+        for row in reader:
+            if 0 < len(row) and not row[0].startswith('#'):
+                return row
+        raise ValueError("No data headers in "+self.dataFile)
+
+    def getChannelColumns(self, columnHeaders, args):
+        wanted = getNeededChannels(args)
+        return [(k, columnHeaders.index(v)) for k, v in self.dataLogPoints.items() if k in wanted]
 
-        with open(self.dataFile, "r") as fileHandle:
+    def getChannelNames(self):
+        with open(self.dataFile, "r", newline='') as fileHandle:
+            return self.readColumnHeaders(csv.reader(fileHandle))
+
+    def readSessionData(self, args):
+        with open(self.dataFile, "r", newline='') as fileHandle:
             reader = csv.reader(fileHandle)
-            for row in reader:
-                unparsedData.append(row)
-
-        # Parse through the in-memory array for metadata
-        # TODO: Get track name from cmd line options
-        #    For now, default to VIR Full
-        self.session.addSessionInfo(trackName = "VIR Full")
-        self.session.loadTrack()
-
-        # remove the metadata from the in-memory array
-        for i in range(16):
-            del unparsedData[0]
-
-        # first array entry right now is data headers
-        columnHeaders = unparsedData[0]
-        del unparsedData[0]
-        # Process all datapoints
-        for row in unparsedData:
-            if row[0].startswith('#'):
-                continue
-            self.session.addMeasurement(row[columnHeaders.index(self.dataLogPoints["time"])],
-                GPSlat = float(row[columnHeaders.index(self.dataLogPoints["GPSlat"])]),
-                GPSlng = float(row[columnHeaders.index(self.dataLogPoints["GPSlng"])]),
-                throttle = float(row[columnHeaders.index(self.dataLogPoints["throttle"])]),
-                brake = float(row[columnHeaders.index(self.dataLogPoints["brake"])]),
-                heading = float(row[columnHeaders.index(self.dataLogPoints["heading"])]),
-                lateralAccel = float(row[columnHeaders.index(self.dataLogPoints["lateralAccel"])]),
-                inlineAccel = float(row[columnHeaders.index(self.dataLogPoints["inlineAccel"])])
-            )
 
+            # Parse through the metadata
+            # TrackAddict files don't carry a track name - take it from the command line, or recognise
+            # the track from the GPS data below
+            if args.trackname:
+                self.session.addSessionInfo(trackName = args.trackname)
+                self.session.loadTrack(args)
+
+            columnHeaders = self.readColumnHeaders(reader)
+            columns = self.getChannelColumns(columnHeaders, args)
+
+            # Process all datapoints
+            with profiling.stage("parse"):
+                self.session.setChannels(loadChannelColumns(fileHandle, columns, skipComments=self.skipComments))
+
+        if self.session.track is None:
+            self.session.matchTrack(args)
+        # Nothing matched: fall back to the old default
+        if self.session.track is None:
+            self.session.addSessionInfo(trackName = "VIR Full")
+            self.session.loadTrack(args)
+        with profiling.stage("lapDetection"):
+            self.session.assignLapsAndSegments(args)
         return self.session
@@ -4,253 +4,742 @@
 # Each session is composed of 0 or 1 "out lap", and 0 or more "track laps"
 # The final lap sensed will be designated the "out lap" for discussion purposes
 # Each lap is a time-series of measurements.
-# Each measurement is a "timechop" - number of second since the start of data recording - and an 
+# Each measurement is a "timechop" - number of second since the start of data recording - and an
 #  arbitrary number of keyword arguments. Possbilities include GPS position (longitude and latitude),
 #  engine RPM, GPS heading, brake pressure, wheel speeds (FR, FL, RR, RL), and others. The specific
 #  keyword argument datapoints will be determined by the data reading function. In here, we don't
 #  (yet) care about what they actually are.
+#
+# Measurements are stored by column: one contiguous NumPy array per datapoint ("channel"), plus
+#  integer "lap" and "segment" channels. Laps are [start, stop) index ranges into those arrays, and
+#  laps and segments are handed out as SessionSlice views rather than lists of per-sample dicts.
 
 import pprint
+import hashlib
 import utils
+import trackRegistry
+import kdTree
 import math
+from array import array
 from datetime import datetime
+import os.path
+import numpy as np
+
+# A contiguous run of samples in a session - a lap, a segment of a lap, or any other window.
+# Indexing with a channel name returns a NumPy view of that channel over the run, nothing is copied.
+class SessionSlice:
+    def __init__(self, session, start, stop):
+        self.session = session
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, channel):
+        return self.session.channels[channel][self.start:self.stop]
+
+    def __contains__(self, channel):
+        return channel in self.session.channels
+
+    def positions(self):
+        # (lat, lng) pairs as an N x 2 array, the layout the map code and distance functions expect
+        return np.column_stack((self["GPSlat"], self["GPSlng"]))
+
+    def simplifiedPositions(self, tolerance):
+        # positions() with the points that don't move the trace by more than tolerance feet dropped
+        # (Douglas-Peucker). A tolerance of 0 or less keeps every point.
+        positions = self.positions()
+        if tolerance <= 0:
+            return positions
+        return positions[self.session.getTraceSignificance(self) > tolerance]
+
+    def elapsed(self):
+        if len(self) < 2:
+            return 0.0
+        times = self["time"]
+        return float(times[-1] - times[0])
+
+    def measurement(self, idx):
+        # One sample as a dict - only meant for debugging output
+        return {k: v[self.start+idx].item() for k, v in self.session.channels.items()}
+
+    def measurements(self):
+        return [self.measurement(idx) for idx in range(len(self))]
+
+# When the session was driven. Files without a date (TrackAddict) fall back to when the data file was
+# last written, and to None when that can't be found either.
+def getSessionDateTime(sessioninfo):
+    if "sessionDate" in sessioninfo and "sessionTime" in sessioninfo:
+        return datetime.strptime(sessioninfo["sessionDate"]+" "+sessioninfo["sessionTime"], "%A, %B %d, %Y %I:%M %p")
+    if "sourcefile" in sessioninfo and os.path.isfile(sessioninfo["sourcefile"]):
+        return datetime.fromtimestamp(os.path.getmtime(sessioninfo["sourcefile"]))
+    return None
+
+# Session metadata lookups shared by TrackSession and SessionSummary
+def lookupSessionInfo(sessioninfo, item):
+    if '' == item:
+        return sessioninfo
+    if 'sheetDateTime' == item:
+        dateObj = getSessionDateTime(sessioninfo)
+        if dateObj is None:
+            return None
+        dateStr = dateObj.strftime("%m-%d %H:%M")
+        return dateStr
+    if 'simpleDate' == item:
+        dateObj = getSessionDateTime(sessioninfo)
+        # Nothing to go by but the file name
+        if dateObj is None:
+            return os.path.splitext(os.path.basename(sessioninfo.get("sourcefile", "undated")))[0]
+        dateStr = dateObj.strftime("%Y-%m-%d-%H%M")
+        return dateStr
+    if item not in sessioninfo.keys():
+        return None
+    return sessioninfo[item]
+
+# Start and stop sample indexes and elapsed time of every lap x segment of a session, found in one pass:
+# within a lap the segment numbers never decrease and the laps follow each other, so
+# (lap, segment) keys are sorted across the whole session and one searchsorted finds every boundary.
+# Rows are laps, columns are segment numbers 0..len(waypoints)+1 (0 being "not yet on track").
+class SegmentIndex:
+    def __init__(self, session):
+        laps = session.getLaps()
+        self.numLaps = len(laps)
+        self.width = len(session.waypoints) + 2
+        active = session.getActiveSlice()
+        lapIndex = np.repeat(np.arange(self.numLaps), [len(lap) for lap in laps])
+        keys = lapIndex*self.width + active["segment"]
+        targets = np.arange(self.numLaps*self.width)
+        self.starts = (np.searchsorted(keys, targets, side='left') + active.start).reshape(self.numLaps, self.width)
+        self.stops = (np.searchsorted(keys, targets, side='right') + active.start).reshape(self.numLaps, self.width)
+
+        times = session.channels["time"] if 0 < self.numLaps else np.zeros(1)
+        last = len(times) - 1
+        firstTimes = times[np.minimum(self.starts, last)]
+        lastTimes = times[np.clip(self.stops-1, 0, last)]
+        self.times = np.where(self.stops - self.starts > 1, lastTimes - firstTimes, 0.0)
+
+    def getTimes(self, segNum):
+        if segNum < 0 or segNum >= self.width:
+            return [0.0] * self.numLaps
+        return self.times[:, segNum].tolist()
+
+    def getSegment(self, session, lapIdx, segNum):
+        if segNum < 0 or segNum >= self.width:
+            start = session.lapRanges[lapIdx][0]
+            return SessionSlice(session, start, start)
+        return SessionSlice(session, int(self.starts[lapIdx, segNum]), int(self.stops[lapIdx, segNum]))
+
+# Map boundaries, [southWest, northEast], from the extremes of a set of points. Gives the same corners
+# as getPointBoundaries()' comparison of absolute values, for points on one side of the equator and
+# of the prime meridian.
+def extremesToBoundaries(minLat, maxLat, minLng, maxLng):
+    if minLat >= 0:
+        south, north = minLat, maxLat
+    else:
+        south, north = maxLat, minLat
+    if maxLng <= 0:
+        west, east = minLng, maxLng
+    else:
+        west, east = maxLng, minLng
+    return [[float(south), float(west)], [float(north), float(east)]]
+
+# Bounding box of every lap and every segment of every lap, computed together in a single pass with
+# reduceat, so framing a map is a dict lookup instead of a scan over its samples.
+# extremes maps (start, stop) to (min lat, max lat, min lng, max lng).
+class RangeBounds:
+    def __init__(self, session):
+        ranges = [(start, stop) for start, stop in session.lapRanges]
+        index = session.getSegmentIndex()
+        ranges += list(zip(index.starts.ravel().tolist(), index.stops.ravel().tolist()))
+        ranges = sorted(set((start, stop) for start, stop in ranges if start < stop))
+        self.extremes = {}
+        if 0 == len(ranges):
+            return
+        # Each range is one [start, stop) pair of reduceat indexes; the results between pairs are
+        # dropped. One padding sample keeps a stop at the end of the data a valid index.
+        edges = np.array(ranges).ravel()
+        lat = np.append(session.channels["GPSlat"], 0.0)
+        lng = np.append(session.channels["GPSlng"], 0.0)
+        minLat = np.minimum.reduceat(lat, edges)[::2]
+        maxLat = np.maximum.reduceat(lat, edges)[::2]
+        minLng = np.minimum.reduceat(lng, edges)[::2]
+        maxLng = np.maximum.reduceat(lng, edges)[::2]
+        for idx, key in enumerate(ranges):
+            self.extremes[key] = (minLat[idx], maxLat[idx], minLng[idx], maxLng[idx])
+
+    def getExtremes(self, start, stop):
+        return self.extremes.get((start, stop))
+
+# KD-tree over every sample of a session, projected to feet around the start/finish line, for
+# nearest-sample, radius and bounding box queries. Depends only on the samples, so it outlives lap and
+# trim changes. Returns sample indexes into the channel arrays.
+class SpatialIndex:
+    def __init__(self, session):
+        positions = np.column_stack((session.channels["GPSlat"], session.channels["GPSlng"]))
+        if 2 == len(session.trackStartFinish):
+            self.origin = session.trackStartFinish
+        else:
+            self.origin = tuple(positions[0]) if 0 < len(positions) else (0.0, 0.0)
+        self.xy = utils.projectLocal(positions, self.origin)
+        self.tree = kdTree.KDTree(self.xy)
+        # Trees over just the samples start..stop-1 (a lap), built on first use
+        self.rangeTrees = {}
+
+    def project(self, point):
+        return utils.projectLocal(np.asarray(point, dtype=float).reshape(1, 2), self.origin)[0]
+
+    def getRangeTree(self, start, stop):
+        if (start, stop) not in self.rangeTrees:
+            self.rangeTrees[(start, stop)] = kdTree.KDTree(self.xy[start:stop])
+        return self.rangeTrees[(start, stop)]
+
+    # (sample index, distance in feet) of the sample nearest point, optionally only among samples
+    # start..stop-1. Every lap passes every spot on the track, so limiting the whole session's tree to
+    # one lap would still search the leaves of every lap near the point - a range is searched in a
+    # tree of its own.
+    def getNearestSample(self, point, start=None, stop=None):
+        if start is None:
+            return self.tree.nearest(self.project(point))
+        idx, distance = self.getRangeTree(start, stop).nearest(self.project(point))
+        return (None if idx is None else start + idx), distance
+
+    def getSamplesNear(self, point, radius):
+        return self.tree.withinRadius(self.project(point), radius)
+
+    # Samples inside [southWest, northEast]. The local projection keeps lat/lng boxes rectangular.
+    def getSamplesInBox(self, boundaries):
+        corners = utils.projectLocal(np.asarray(boundaries, dtype=float), self.origin)
+        return self.tree.inBox(corners.min(axis=0), corners.max(axis=0))
+
+# Spacing of the distance grid laps are resampled onto, in feet
+resampleStep = 5.0
+# Half-width of the distance window speeds are measured over, in feet
+speedWindow = 25.0
+# Compass angles, unwrapped before interpolating so 359 -> 1 doesn't pass through 180 on the way
+angleChannels = ("heading",)
+FEET_PER_MILE = 5280.0
+
+# Every lap resampled onto one grid of distance from the start of the lap, so that laps can be compared
+# point for point: channel overlays, time deltas and speed differences for any set of laps are plain
+# array arithmetic. The hot laps are stretched to the median hot lap length first, so that the small
+# differences in measured distance (GPS noise, a wider line) don't let them drift apart towards the end
+# of the lap; the partial out and in laps are left as measured.
+# values is laps x channels x grid points, NaN past the end of a lap.
+class LapResampling:
+    def __init__(self, session, step=resampleStep):
+        laps = session.getLaps()
+        self.channelNames = [k for k in session.channels.keys() if k not in ("lap", "segment")]
+        self.channelIdx = {k: idx for idx, k in enumerate(self.channelNames)}
+        distances = [np.cumsum(utils.calculateStepDistances(lap.positions())) for lap in laps]
+        self.lapLengths = [float(d[-1]) if 0 < len(d) else 0.0 for d in distances]
+        hotLengths = self.lapLengths[1:-1]
+        if 0 < len(hotLengths):
+            self.referenceLength = float(np.median(hotLengths))
+            for lapIdx in range(1, len(laps)-1):
+                if 0 < self.lapLengths[lapIdx]:
+                    distances[lapIdx] = distances[lapIdx] * (self.referenceLength/self.lapLengths[lapIdx])
+        else:
+            self.referenceLength = max(self.lapLengths, default=0.0)
+        gridEnd = max([self.referenceLength] + [float(d[-1]) for d in distances if 0 < len(d)])
+        self.step = step
+        self.distance = np.arange(0.0, gridEnd+step, step)
+
+        self.values = np.full((len(laps), len(self.channelNames), len(self.distance)), np.nan)
+        angles = [self.channelIdx[k] for k in angleChannels if k in self.channelIdx]
+        for lapIdx, (lap, lapDistance) in enumerate(zip(laps, distances)):
+            rows = np.vstack([lap[k] for k in self.channelNames]) if 0 < len(lap) else np.zeros((len(self.channelNames), 0))
+            for idx in angles:
+                rows[idx] = np.degrees(np.unwrap(np.radians(rows[idx])))
+            self.values[lapIdx] = utils.interpolateRows(lapDistance, rows, self.distance)
+        for idx in angles:
+            self.values[:, idx] = np.mod(self.values[:, idx], 360)
+
+    def __len__(self):
+        return len(self.values)
+
+    # channel over the grid, laps x grid points (or one lap's row with a single lap index)
+    def getChannel(self, channel, laps):
+        return self.values[laps, self.channelIdx[channel]]
+
+    # Seconds since the start of the lap at every grid point
+    def getElapsed(self, laps):
+        times = self.values[:, self.channelIdx["time"]]
+        return (times - times[:, :1])[laps]
+
+    # How far each lap is behind (positive) or ahead of referenceLap at every grid point
+    def getDeltaTimes(self, laps, referenceLap):
+        elapsed = self.getElapsed(slice(None))
+        return elapsed[laps] - elapsed[referenceLap]
+
+    # Speed in mph at every grid point, from the time taken to cover speedWindow feet either side of it,
+    # so it is there for GPS-only data too. Over a single grid step the GPS noise in the distances
+    # shows up as speed spikes.
+    def getSpeeds(self, laps):
+        times = self.values[laps, self.channelIdx["time"]]
+        k = max(1, int(round(speedWindow / self.step)))
+        speeds = np.full(times.shape, np.nan)
+        if times.shape[-1] > 2*k:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                speeds[..., k:-k] = (2*k*self.step) / (times[..., 2*k:] - times[..., :-2*k])
+        return speeds * 3600 / FEET_PER_MILE
+
+    def getSpeedDifferences(self, laps, referenceLap):
+        return self.getSpeeds(laps) - self.getSpeeds(referenceLap)
+
+# Per-segment statistics for the report, each computed once
+class SegmentSummary:
+    def __init__(self, session, segNum):
+        self.times = session.getSegmentTimes(segNum)
+        self.hotTimes = session.getSegmentHotTimes(segNum)
+        self.average = utils.averageFilter(self.times)
+        self.stdDev = utils.stdDevFilter(self.times)
+        self.minimum = session.getSegmentMinimum(segNum)
+        self.minDelta = session.getSegmentMinDelta(segNum) if len(self.times) > 1 else 0
+        self.hotAverage = utils.averageFilter(self.hotTimes)
+        self.hotStdDev = utils.stdDevFilter(self.hotTimes)
+        self.hotMinimum = session.getSegmentHotMinimum(segNum)
+        self.hotMinDelta = session.getSegmentHotMinDelta(segNum)
+
+# The results of a session without its channel data - metadata, lap times and lap / segment
+# statistics. This is what the report template reads, and it is cheap to pass between processes
+# and to keep around when many sessions are handled in one run.
+class SessionSummary:
+    def __init__(self, session):
+        self.sessioninfo = dict(session.sessioninfo)
+        self.lapTimes = session.getLapTimes()
+        self.hotLapTimes = session.getHotLapTimes()
+        self.lapAverage = utils.averageFilter(self.lapTimes)
+        self.lapStdDev = utils.stdDevFilter(self.lapTimes)
+        self.hotLapAverage = utils.averageFilter(self.hotLapTimes)
+        self.hotLapStdDev = utils.stdDevFilter(self.hotLapTimes)
+        self.segments = {}
+        for segNum in range(1, len(session.waypoints)+2):
+            self.segments[segNum] = SegmentSummary(session, segNum)
+
+    def getSessionInfo(self, item):
+        return lookupSessionInfo(self.sessioninfo, item)
+
+    def getLapTimes(self):
+        return list(self.lapTimes)
+
+    def getHotLapTimes(self):
+        return list(self.hotLapTimes)
 
 class TrackSession:
     def __init__(self):
-        self.laps = []
+        self.channels = {}
+        self.lapRanges = []
+        self.untrimmedLapRanges = None
+        self.trimBounds = None
+        self.segmentIndex = None
+        self.lapResampling = None
+        self.rangeBounds = None
+        self.spatialIndex = None
+        self.summary = None
         self.sessioninfo = {}
         self.numLaps = 0
+        self.track = None
         self.trackStartFinish = ()
         self.waypoints = []
-        self.curLap = 0
-        self.curSegment = 0
-        self.nextWaypoint = None
+        self.enterTrackPoint = None
+        self.exitTrackPoint = None
+        # Samples added with addMeasurement() are staged in compact typed buffers and moved into
+        # the channel arrays by flush(). Laps and segments are assigned afterwards, in one pass over
+        # the arrays, by assignLapsAndSegments().
+        self.pending = {}
+        self.numSamples = 0
+        # Douglas-Peucker significance of each point of the traces drawn so far, keyed by (start, stop).
+        # Depends only on the samples, so it outlives lap and trim changes.
+        self.traceSignificance = {}
+        # The keys of traceSignificance that are already in the session cache entry
+        self.storedSignificance = set()
 
     # Add session metadata
     def addSessionInfo(self, **kwargs):
         for k,v in kwargs.items():
             self.sessioninfo[k] = v
+        self.summary = None
 
     def getSessionInfo(self, item):
-        if '' == item:
-            return self.sessioninfo
-        if 'sheetDateTime' == item:
-            dateObj = datetime.strptime(self.sessioninfo["sessionDate"]+" "+self.sessioninfo["sessionTime"], "%A, %B %d, %Y %I:%M %p")
-            dateStr = dateObj.strftime("%m-%d %H:%M")
-            return dateStr
-        if 'simpleDate' == item:
-            dateObj = datetime.strptime(self.sessioninfo["sessionDate"]+" "+self.sessioninfo["sessionTime"], "%A, %B %d, %Y %I:%M %p")
-            dateStr = dateObj.strftime("%Y-%m-%d-%H%M")
-            return dateStr
-        if item not in self.sessioninfo.keys():
-            return None
-        return self.sessioninfo[item]
+        return lookupSessionInfo(self.sessioninfo, item)
+
+    def getSummary(self):
+        if self.summary is None:
+            self.summary = SessionSummary(self)
+        return self.summary
+
+    def getSegmentIndex(self):
+        if self.segmentIndex is None:
+            self.segmentIndex = SegmentIndex(self)
+        return self.segmentIndex
+
+    def getRangeBounds(self):
+        if self.rangeBounds is None:
+            self.rangeBounds = RangeBounds(self)
+        return self.rangeBounds
+
+    def getSpatialIndex(self):
+        self.flush()
+        if self.spatialIndex is None:
+            self.spatialIndex = SpatialIndex(self)
+        return self.spatialIndex
+
+    def getLapResampling(self):
+        if self.lapResampling is None:
+            self.lapResampling = LapResampling(self)
+        return self.lapResampling
+
+    # Level-of-detail data for a trace: see utils.traceSignificance. Computed once per trace, after
+    # which the trace can be simplified to any tolerance (i.e. any map zoom) with a comparison.
+    def getTraceSignificance(self, trace):
+        key = (trace.start, trace.stop)
+        if key not in self.traceSignificance:
+            self.traceSignificance[key] = utils.traceSignificance(trace.positions())
+        return self.traceSignificance[key]
 
+    # Drop everything derived from the lap ranges. Called whenever they change.
+    def invalidateIndexes(self):
+        self.segmentIndex = None
+        self.lapResampling = None
+        self.rangeBounds = None
+        self.summary = None
+
+    # Look the track up in the registry - by the track it was matched to before, if it has been
+    # (e.g. a cached session), otherwise by name
     def loadTrack(self, args):
-        trackName = self.sessioninfo["trackName"]
-        if args.verbose:
-            print ("Searching for track: "+self.sessioninfo["trackName"]+".")
-        if "VIR" in trackName.upper():
-            if "full" in trackName.lower():
-                from tracks import VIRfull as track
-        elif "SEBRING" in trackName.upper():
-            from tracks import Sebring as track
-        elif "ROEBLING" in trackName.upper():
-            from tracks import Roebling as track
-        if "track" not in dir():
+        registry = trackRegistry.getRegistry()
+        track = None
+        if "trackId" in self.sessioninfo:
+            track = registry.getTrack(self.sessioninfo["trackId"])
+        elif self.sessioninfo.get("trackName"):
+            if args.verbose:
+                print ("Searching for track: "+self.sessioninfo["trackName"]+".")
+            track = registry.findByName(self.sessioninfo["trackName"])
+        if track is None:
             if args.verbose:
                 print("No track found!")
             return
         if args.verbose:
             print ("Track found.")
-        
+        self.setTrack(track)
+
+    # Recognise the track from the first GPS fixes, for files without a (known) track name.
+    # Needs the channels loaded.
+    def matchTrack(self, args):
+        self.flush()
+        positions = np.column_stack((self.channels["GPSlat"], self.channels["GPSlng"]))
+        track = trackRegistry.getRegistry().findByPositions(positions)
+        if track is None:
+            if args.verbose:
+                print("No track found at the session's location!")
+            return
+        if args.verbose:
+            print ("Track found by location: "+track.description)
+        if not self.sessioninfo.get("trackName"):
+            self.sessioninfo["trackName"] = track.description
+        self.setTrack(track)
+
+    def setTrack(self, track):
+        self.track = track
+        self.sessioninfo["trackId"] = track.name
         self.sessioninfo["trackDescription"] = track.description
         self.trackStartFinish = track.startpoint
         self.waypoints = track.sectorEnds
         self.enterTrackPoint = track.enterTrackPoint
         self.exitTrackPoint = track.exitTrackPoint
-        self.nextWaypoint = self.enterTrackPoint
+        self.summary = None
 
-    def addLap(self):
-        newLap = []
-        self.laps.append(newLap)
-        self.numLaps += 1
-        assert self.numLaps == len(self.laps)
+    # Identifies the track geometry the laps and segments were computed against
+    def getTrackFingerprint(self):
+        geometry = (self.trackStartFinish, tuple(self.waypoints), self.enterTrackPoint, self.exitTrackPoint)
+        return hashlib.sha256(repr(geometry).encode()).hexdigest()
 
     def addMeasurement(self, timeChop, **kwargs):
-        if 0 == len(self.laps):
-            self.addLap()
-            
-        measurement = {"time":float(timeChop)}
-        for k,v in kwargs.items():
-            measurement[k]=v
+        if 0 == len(self.pending):
+            if 0 == len(self.channels):
+                channelNames = ["time"] + list(kwargs.keys())
+            else:
+                channelNames = [k for k in self.channels.keys() if k not in ("lap", "segment")]
+            for k in channelNames:
+                self.pending[k] = array('d')
 
-        prevPoint = self.getLastLocation()
+        self.pending["time"].append(float(timeChop))
+        for k,v in kwargs.items():
+            self.pending[k].append(v)
+        self.numSamples += 1
 
-        curPoint = (measurement["GPSlat"], measurement["GPSlng"])
+    # Install whole channel arrays at once - the bulk alternative to addMeasurement() used by the
+    # importers. Takes a dict of channel name to 1-D array, "time" first.
+    def setChannels(self, channels):
+        self.pending = {}
+        self.channels = {k: np.asarray(v, dtype=np.float64) for k, v in channels.items()}
+        self.numSamples = len(self.channels["time"])
+        self.traceSignificance = {}
+        self.storedSignificance = set()
+        self.spatialIndex = None
 
-        prevDistance = utils.calculateGPSdistance(prevPoint, self.nextWaypoint)
-        curDistance = utils.calculateGPSdistance(curPoint, self.nextWaypoint)
-        pointsinCurLap = len(self.laps[-1])
+    # Lap and segment detection, run once all samples are loaded. We walk the waypoints in the
+    # order they are driven - enterTrackPoint, then each of the sectorEnds, the last of which is the
+    # start/finish line - and a waypoint counts as crossed on the first sample that moves away from
+    # it while within 50 feet of it. Distances from every sample to every waypoint are computed in
+    # one batch, so each crossing is just a search for the next candidate sample past the previous
+    # crossing.
+    def assignLapsAndSegments(self, args):
+        self.flush()
+        numSamples = len(self.channels["time"]) if "time" in self.channels else 0
+        boundaries = [0]
+        lapValues = [0]
+        segmentValues = [0]
+        lapStarts = [0]
 
-        if None == prevPoint:
-            self.curLap = 0
-            self.curSegment = 0
-            prevDistance = 10000  # Artificially high number to ensure it is always greater than curDistance
+        if numSamples > 1 and self.track is not None:
+            targets = self.track.targets
+            positions = np.column_stack((self.channels["GPSlat"], self.channels["GPSlng"]))
+            distances = self.track.distances(positions, self.track.targetsXY)
+            leaving = (distances[1:] > distances[:-1]) & (50 > distances[1:])
+            candidates = [np.flatnonzero(leaving[:, k]) + 1 for k in range(len(targets))]
 
-        if curDistance > prevDistance and 50 > curDistance:
-            if self.nextWaypoint == self.enterTrackPoint:
-                # We have entered the track. Begin lap 1.
-                self.curLap = 1
-                self.curSegment = 1
-                self.nextWaypoint = self.waypoints[0]
-                print ("Entering track")
-            else:
-                # We are in the middle of the session and have crossed a waypoint.
-                if self.nextWaypoint == self.trackStartFinish:
+            target = 0
+            curLap = 0
+            curSegment = 0
+            crossing = 0
+            while True:
+                found = np.searchsorted(candidates[target], crossing, side='right')
+                if found == len(candidates[target]):
+                    break
+                crossing = int(candidates[target][found])
+                if 0 == target:
+                    # We have entered the track. Begin lap 1.
+                    curLap = 1
+                    curSegment = 1
+                    target = 1
+                elif targets[target] == self.trackStartFinish:
                     # We have started a new lap
-                    self.addLap()
-                    self.curLap += 1
-                    self.curSegment = 1
-                    self.nextWaypoint = self.waypoints[0]
-                    print("Starting new lap.")
+                    lapStarts.append(crossing)
+                    curLap += 1
+                    curSegment = 1
+                    target = 1
                 else:
                     # We have crossed a simple segment boundary within a lap
-                    self.nextWaypoint = self.waypoints[self.curSegment]
-                    self.curSegment += 1
-                    print("Entering segment "+str(self.curSegment))
-        else:
-            pass
+                    curSegment += 1
+                    target += 1
+                if args.verbose and args.verbose > 1:
+                    print("Lap "+str(curLap)+", segment "+str(curSegment)+" begins at "+str(self.channels["time"][crossing]))
+                boundaries.append(crossing)
+                lapValues.append(curLap)
+                segmentValues.append(curSegment)
 
-        measurement["lap"] = self.curLap
-        measurement["segment"] = self.curSegment
-        self.laps[-1].append(measurement)
+        runLengths = np.diff(boundaries + [numSamples])
+        self.channels["lap"] = np.repeat(np.array(lapValues, dtype=np.int32), runLengths)
+        self.channels["segment"] = np.repeat(np.array(segmentValues, dtype=np.int32), runLengths)
+        self.lapRanges = [[start, stop] for start, stop in zip(lapStarts, lapStarts[1:] + [numSamples]) if start < stop]
+        self.numLaps = len(self.lapRanges)
+        self.untrimmedLapRanges = None
+        self.trimBounds = None
+        self.invalidateIndexes()
+        if args.verbose:
+            print("Laps detected: "+str(self.numLaps))
+
+    # Move staged samples into the channel arrays. Every reader goes through here first.
+    def flush(self):
+        if 0 == len(self.pending):
+            return
+        for k, buf in self.pending.items():
+            newData = np.array(buf, dtype=np.float64)
+            if k in self.channels:
+                self.channels[k] = np.concatenate((self.channels[k], newData))
+            else:
+                self.channels[k] = newData
+        self.pending = {}
+        self.traceSignificance = {}
+        self.storedSignificance = set()
+        self.spatialIndex = None
+
+    # The portion of the channel arrays covered by laps - i.e. what is left after trimEnds()
+    def getActiveSlice(self):
+        self.flush()
+        if 0 == len(self.lapRanges):
+            return SessionSlice(self, 0, 0)
+        return SessionSlice(self, self.lapRanges[0][0], self.lapRanges[-1][1])
+
+    def getChannel(self, channel):
+        return self.getActiveSlice()[channel]
 
     def trimEnds(self, args):
-        # Trims the start of the out lap and the end of the last lap so that we don't have GPS tracks 
+        # Trims the start of the out lap and the end of the last lap so that we don't have GPS tracks
         # following us into and through the paddock.
-        numLaps = len(self.laps)
-        inLapPoints = len(self.laps[0])
-        outLapPoints = len(self.laps[-1])
+        # The first on-track sample is found with one batch distance computation against enterTrackPoint,
+        # the last one against exitTrackPoint, and the first and last lap ranges are narrowed to them.
+        # Nothing is deleted: the untrimmed lap ranges are kept (getUntrimmedLaps(), untrimEnds()) and
+        # trimBounds holds the [start, stop) sample range that survived.
+        self.flush()
+        numLaps = len(self.lapRanges)
+        inLapPoints = len(self.getLaps()[0])
+        outLapPoints = len(self.getLaps()[-1])
+        if self.untrimmedLapRanges is None:
+            self.untrimmedLapRanges = [list(lapRange) for lapRange in self.lapRanges]
         if args.verbose:
             print ("In lap datapoints: "+str(inLapPoints))
-            print ("Second lap datapoints: "+str(len(self.laps[1])))
+            print ("Second lap datapoints: "+str(len(self.getLaps()[1])))
             if args.verbose > 3:
-                print("Distance to track start point: "+str(utils.calculateGPSdistance(self.enterTrackPoint, (self.laps[0][0]["GPSlat"], self.laps[0][0]["GPSlng"]))) )
+                print("Distance to track start point: "+str(utils.calculateGPSdistance(self.enterTrackPoint, self.getLocation(self.lapRanges[0][0]))) )
 
-        # Starting at datapoint 0, if we are not within 10 feet of enterTrackPoint, we don't care about this datapoint
-        
-        while (15 < utils.calculateGPSdistance(self.enterTrackPoint, (self.laps[0][0]["GPSlat"], self.laps[0][0]["GPSlng"]))):
-            del self.laps[0][0]
+        # Starting at datapoint 0, if we are not within 15 feet of enterTrackPoint, we don't care about this datapoint
+        firstLap = self.getLaps()[0]
+        enterDistances = self.track.distances(firstLap.positions(), self.track.enterXY)[:, 0]
+        onTrack = np.flatnonzero(15 >= enterDistances)
+        if 0 == len(onTrack):
+            del self.lapRanges[0]
+        else:
+            self.lapRanges[0][0] = firstLap.start + int(onTrack[0])
             if args.verbose and args.verbose > 4:
-                print("Distance to NEW track start point: "+str(utils.calculateGPSdistance(self.enterTrackPoint, (self.laps[0][0]["GPSlat"], self.laps[0][0]["GPSlng"]))) )
-            if len(self.laps[0]) == 0:
-                del self.laps[0]
-                break
+                print("Distance to NEW track start point: "+str(enterDistances[onTrack[0]]))
 
         # starting with the last datapoint and working backwards, if we're not within 10 feet of exitTrackPoint, we
         # get rid of the point
         if not args.no_trim_tail:
-            while (10 < utils.calculateGPSdistance(self.exitTrackPoint, (self.laps[-1][-1]["GPSlat"], self.laps[-1][-1]["GPSlng"]))):
+            lastLap = self.getLaps()[-1]
+            exitDistances = self.track.distances(lastLap.positions(), self.track.exitXY)[:, 0]
+            onTrack = np.flatnonzero(10 >= exitDistances)
+            if 0 == len(onTrack):
+                self.lapRanges[-1][1] = lastLap.start
+            else:
+                self.lapRanges[-1][1] = lastLap.start + int(onTrack[-1]) + 1
                 if args.verbose and args.verbose > 4:
-                    print ("Distance to track exit point:"+str(utils.calculateGPSdistance(self.exitTrackPoint, (self.laps[-1][-1]["GPSlat"], self.laps[-1][-1]["GPSlng"]))))
-                del self.laps[-1][-1]
+                    print ("Distance to track exit point:"+str(exitDistances[onTrack[-1]]))
+
+        self.trimBounds = (self.lapRanges[0][0], self.lapRanges[-1][1])
+        self.invalidateIndexes()
+
+        assert (len(self.lapRanges) < numLaps) or (len(self.getLaps()[0]) < inLapPoints)
+        assert args.no_trim_tail or (len(self.getLaps()[-1]) < outLapPoints)
+        assert len(self.getLaps()[-1]) > 0
+
+    # The laps as they were before trimEnds() - the out lap still starting in the paddock
+    def getUntrimmedLaps(self):
+        self.flush()
+        if self.untrimmedLapRanges is None:
+            return self.getLaps()
+        return [SessionSlice(self, start, stop) for start, stop in self.untrimmedLapRanges]
+
+    def untrimEnds(self):
+        if self.untrimmedLapRanges is None:
+            return
+        self.lapRanges = self.untrimmedLapRanges
+        self.numLaps = len(self.lapRanges)
+        self.untrimmedLapRanges = None
+        self.trimBounds = None
+        self.invalidateIndexes()
 
-        assert (len(self.laps) < numLaps) or (len(self.laps[0]) < inLapPoints)
-        assert args.no_trim_tail or (len(self.laps[-1]) < outLapPoints)
-        assert len(self.laps[-1]) > 0
+    def getLocation(self, idx):
+        self.flush()
+        return (float(self.channels["GPSlat"][idx]), float(self.channels["GPSlng"][idx]))
 
     def getLastLocation(self):
-        if 0 == len(self.laps):
+        if 0 == len(self.lapRanges):
             return None
-        if 0 == len(self.laps[-1]):
+        if self.lapRanges[-1][0] == self.lapRanges[-1][1]:
             return None
-        measurement = self.laps[-1][-1]
-        return (measurement["GPSlat"], measurement["GPSlng"])
+        return self.getLocation(self.lapRanges[-1][1]-1)
 
     def getLastDistanceTraversed(self):
-        measurement = self.laps[-1][-2]
-        point1 = (measurement["GPSlat"], measurement["GPSlng"])
+        point1 = self.getLocation(self.lapRanges[-1][1]-2)
         point2 = self.getLastLocation()
-        return utils.calculateGPSdistance( (point1["GPSlat"], point1["GPSlng"]), (point2["GPSlat"], point2["GPSlng"]) )
+        return utils.calculateGPSdistance(point1, point2)
 
     def dumpMetadata(self):
         pprint.pprint(self.sessioninfo)
-        print ("Number of laps:", len(self.laps))
+        print ("Number of laps:", len(self.lapRanges))
 
     def dumpLap(self, lapNumber):
-        pprint.pprint(self.laps[lapNumber])
+        pprint.pprint(self.getLaps()[lapNumber].measurements())
 
     def getLapTime(self, lapNumber):
-        start = float(self.laps[lapNumber][0]["time"])
-        end = float(self.laps[lapNumber][-1]["time"])
-        elapsed = end - start
-        return elapsed
+        return self.getLaps()[lapNumber].elapsed()
 
     def getLapTimes(self):
-        times = []
-        for f in range(len(self.laps)):
-            times.append(self.getLapTime(f))
-        return times
+        return [lap.elapsed() for lap in self.getLaps()]
 
     def getHotLapTimes(self):
-        times = []
-        for f in range(1, len(self.laps)-1):
-            times.append(self.getLapTime(f))
-        return times
+        return self.getLapTimes()[1:-1]
+
+    # Index of the fastest hot lap - of the fastest lap if there are no hot laps
+    def getFastestLap(self):
+        hotLapTimes = self.getHotLapTimes()
+        if 0 < len(hotLapTimes):
+            return 1 + int(np.argmin(hotLapTimes))
+        return int(np.argmin(self.getLapTimes()))
 
     def getDataPointsAvail(self):
-        dataPoints = []
-        for lap in self.laps:
-            for measurement in lap:
-                for point in measurement.keys():
-                    if point not in dataPoints:
-                        dataPoints.append(point)
-        return dataPoints
-    
+        self.flush()
+        return list(self.channels.keys())
+
     def getSegments(self):
+        index = self.getSegmentIndex()
         sessRet = []
-        for lap in self.laps:
+        for lapIdx in range(len(self.lapRanges)):
             thisLap = []
-            for segment in range(len(self.waypoints)+1):
-                thisLap.append([])              
-            for measurement in lap:
-                thisLap[measurement["segment"]-1].append(measurement)
+            for segment in range(1, len(self.waypoints)+2):
+                thisLap.append(index.getSegment(self, lapIdx, segment))
             sessRet.append(thisLap)
         return sessRet
-    
-    def getImageBoundaries(self):
-        southWest = []
-        northEast = []
-        southWest = [self.trackStartFinish[0], self.trackStartFinish[1]]
-        northEast = [self.trackStartFinish[0], self.trackStartFinish[1]]
-        for lap in self.laps:
-            for measurement in lap:
-                if abs(measurement["GPSlat"]) < abs(southWest[0]):
-                    southWest[0] = measurement["GPSlat"]
-                if abs(measurement["GPSlat"]) > abs(northEast[0]):
-                    northEast[0] = measurement["GPSlat"]
-                if abs(measurement["GPSlng"]) > abs(southWest[1]):
-                    southWest[1] = measurement["GPSlng"]
-                if abs(measurement["GPSlng"]) < abs(northEast[1]):
-                    northEast[1] = measurement["GPSlng"]
+
+    # Bounding box of a set of points, keeping the original comparison on absolute values
+    # (North / West hemisphere tracks).
+    def getPointBoundaries(self, lats, lngs):
+        absLats = np.abs(lats)
+        absLngs = np.abs(lngs)
+        southWest = [float(lats[np.argmin(absLats)]), float(lngs[np.argmax(absLngs)])]
+        northEast = [float(lats[np.argmax(absLats)]), float(lngs[np.argmin(absLngs)])]
         return [southWest, northEast]
 
+    # All the laps and the start/finish line, from the laps' precomputed extremes
+    def getImageBoundaries(self):
+        self.flush()
+        bounds = self.getRangeBounds()
+        extremes = [bounds.getExtremes(start, stop) for start, stop in self.lapRanges if start < stop]
+        extremes.append((self.trackStartFinish[0], self.trackStartFinish[0], self.trackStartFinish[1], self.trackStartFinish[1]))
+        extremes = np.array(extremes)
+        return extremesToBoundaries(extremes[:, 0].min(), extremes[:, 1].max(), extremes[:, 2].min(), extremes[:, 3].max())
+
+    # Laps and segments come from the precomputed extremes; anything else is worked out from its samples
     def getSeriesBoundaries(self, measurements):
-        southWest = []
-        northEast = []
-        southWest = [measurements[0]["GPSlat"], measurements[0]["GPSlng"]]
-        northEast = [measurements[0]["GPSlat"], measurements[0]["GPSlng"]]
-        for measurement in measurements:
-            if abs(measurement["GPSlat"]) < abs(southWest[0]):
-                southWest[0] = measurement["GPSlat"]
-            if abs(measurement["GPSlat"]) > abs(northEast[0]):
-                northEast[0] = measurement["GPSlat"]
-            if abs(measurement["GPSlng"]) > abs(southWest[1]):
-                southWest[1] = measurement["GPSlng"]
-            if abs(measurement["GPSlng"]) < abs(northEast[1]):
-                northEast[1] = measurement["GPSlng"]
-        return [southWest, northEast]
+        if isinstance(measurements, SessionSlice) and measurements.session is self and 0 < len(measurements):
+            extremes = self.getRangeBounds().getExtremes(measurements.start, measurements.stop)
+            if extremes is not None:
+                return extremesToBoundaries(*extremes)
+        return self.getPointBoundaries(np.asarray(measurements["GPSlat"]), np.asarray(measurements["GPSlng"]))
+
+    # The sample nearest point (lat, lng), and its distance in feet
+    def getNearestSample(self, point):
+        return self.getSpatialIndex().getNearestSample(point)
+
+    # The samples of each lap within radius feet of point, as one array of sample indexes per lap
+    def getLapSamplesNear(self, point, radius):
+        near = self.getSpatialIndex().getSamplesNear(point, radius)
+        return [near[np.searchsorted(near, start):np.searchsorted(near, stop)] for start, stop in self.lapRanges]
+
+    # The sample of each lap nearest point, and its distance in feet - (None, inf) for an empty lap
+    def getNearestLapSamples(self, point):
+        index = self.getSpatialIndex()
+        return [index.getNearestSample(point, start, stop) for start, stop in self.lapRanges]
+
+    # Each lap's pass through a corner: the run of samples from the first to the last one within radius
+    # feet of point, as a SessionSlice - None for a lap that doesn't come that close. Compare laps at a
+    # corner with these instead of whole laps or segments.
+    def getCornerWindows(self, point, radius=100.0):
+        windows = []
+        for near in self.getLapSamplesNear(point, radius):
+            if 0 == len(near):
+                windows.append(None)
+            else:
+                windows.append(SessionSlice(self, int(near[0]), int(near[-1])+1))
+        return windows
+
+    # Sample indexes inside [southWest, northEast]
+    def getSamplesInBox(self, boundaries):
+        return self.getSpatialIndex().getSamplesInBox(boundaries)
 
     def getSeriesCenterpoint(self, measurements):
         #if 2 > len(measurements):
@@ -261,69 +750,56 @@ class TrackSession:
 
     def getMapLocation(self):
         return [self.trackStartFinish[0], self.trackStartFinish[1]]
-    
+
     def getLaps(self):
-        return self.laps
-    
+        self.flush()
+        return [SessionSlice(self, start, stop) for start, stop in self.lapRanges]
+
+    laps = property(getLaps)
+
     def getSegmentsByTime(self, segNum):
+        index = self.getSegmentIndex()
         segments = []
-        shortSegment = []
-        lapNum = 0 
-        for lap in self.laps:
-            lapNum += 1
-            for measurement in lap:
-                if measurement["segment"] == segNum:
-                    shortSegment.append(measurement)
-            if len(shortSegment) > 1:
-                segTime = shortSegment[-1]["time"] - shortSegment[0]["time"]
-            else:
-                segTime = 0
-            segments.append({"time": segTime, "path": shortSegment, "lap": lapNum})
-            shortSegment=[]
+        for lapIdx, segTime in enumerate(index.getTimes(segNum)):
+            segments.append({"time": segTime, "path": index.getSegment(self, lapIdx, segNum), "lap": lapIdx+1})
         return segments
-    
+
     def getSegmentTimes(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = [float(item["time"]) for item in segments]
+        times = self.getSegmentIndex().getTimes(segmentNum)
         if type(times) == type(int):
             return [times]
         if len(times) == 0:
             return [0]
         return times
-    
+
     def getSegmentHotTimes(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = [float(item["time"]) for item in segments[1:-2]]
+        times = self.getSegmentIndex().getTimes(segmentNum)[1:-2]
         if type(times) == type(int):
             return [times]
         if len(times) == 0:
             return [0]
         return times
-    
+
     def getSegmentMinimum(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = [float(item["time"]) for item in segments]
+        times = self.getSegmentIndex().getTimes(segmentNum)
         if len(times) == 0:
             return 0
         return min(times)
-    
+
     def getSegmentHotMinimum(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = [float(item["time"]) for item in segments[1:-2]]
+        times = self.getSegmentIndex().getTimes(segmentNum)[1:-2]
         if len(times) == 0:
             return 0
         return min(times)
-    
+
     def getSegmentMinDelta(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = sorted([float(item["time"]) for item in segments])
+        times = sorted(self.getSegmentIndex().getTimes(segmentNum))
         if len(times) == 0:
             return 0
         return times[1]-times[0]
-    
+
     def getSegmentHotMinDelta(self, segmentNum):
-        segments = self.getSegmentsByTime(segmentNum)
-        times = sorted([float(item["time"]) for item in segments[1:-2]])
+        times = sorted(self.getSegmentIndex().getTimes(segmentNum)[1:-2])
         if len(times) == 0:
             return 0
         if len(times) > 1:
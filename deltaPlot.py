@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+# Lap comparison images: the time each lap gains or loses against a reference lap, and the speed of
+# each lap, against distance into the lap. Drawn from the distance-aligned laps of
+# TrackSession.getLapResampling(), on a Figure of its own like the G-G plots.
+
+import numpy as np
+from ggPlot import toPng
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Part of every lap comparison image's artifact cache key - bump when the images change for the same data
+RENDERER_VERSION = 1
+
+figureSize = (9.6, 7.2)
+dpi = 100
+
+# distance is the grid in feet; deltas and speeds are laps x grid points, labelled by labels; the
+# reference lap is drawn in red on the speed plot
+def render(distance, deltas, speeds, labels, referenceSpeeds, referenceLabel):
+    fig = Figure(figsize=figureSize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    deltaAxes, speedAxes = fig.subplots(2, 1, sharex=True)
+
+    deltaAxes.axhline(0.0, color='red', linewidth=1)
+    for delta, label in zip(deltas, labels):
+        deltaAxes.plot(distance, delta, linewidth=1, label=label)
+    deltaAxes.set_ylabel("Time behind "+referenceLabel+" (s)")
+    deltaAxes.grid(True, alpha=0.3)
+    if 0 < len(labels):
+        deltaAxes.legend(fontsize='small', ncol=min(len(labels), 6))
+
+    for speed in speeds:
+        speedAxes.plot(distance, speed, linewidth=0.8, alpha=0.6)
+    speedAxes.plot(distance, referenceSpeeds, color='red', linewidth=1.2, label=referenceLabel)
+    speedAxes.set_xlabel("Distance into the lap (ft)")
+    speedAxes.set_ylabel("Speed (mph)")
+    speedAxes.grid(True, alpha=0.3)
+    speedAxes.legend(fontsize='small')
+    if 0 < len(distance):
+        speedAxes.set_xlim(0, float(np.max(distance)))
+    fig.tight_layout()
+    return toPng(fig)
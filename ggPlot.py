@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+# G-G (lateral vs. inline acceleration) plot images.
+# Every image gets its own matplotlib Figure on the non-interactive Agg canvas - nothing goes through
+# pyplot's global figure, so images can't pick up points from earlier ones and nothing is left open.
+# Two styles:
+#   points  - one marker per sample. Fine for a lap.
+#   density - the samples binned into a 2D histogram with NumPy and drawn as a single image, shaded
+#             by how much time was spent in each cell. Drawing cost doesn't depend on the number of
+#             samples, so this is the one for whole sessions.
+
+import io
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Part of every G-G image's artifact cache key - bump when the images change for the same samples
+RENDERER_VERSION = 2
+
+# Same size as matplotlib's default figure
+figureSize = (6.4, 4.8)
+dpi = 100
+densityBins = 80
+
+def newFigure():
+    fig = Figure(figsize=figureSize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    axes = fig.add_subplot()
+    axes.set_xlabel("Lateral acceleration (g)")
+    axes.set_ylabel("Inline acceleration (g)")
+    return fig, axes
+
+def toPng(fig):
+    imgBuf = io.BytesIO()
+    fig.savefig(imgBuf, format='png')
+    return imgBuf.getvalue()
+
+# The plot covers the same range in both directions, to the next half g past the furthest sample
+def getLimit(x, y):
+    if 0 == len(x):
+        return 1.0
+    furthest = max(float(np.max(np.abs(x))), float(np.max(np.abs(y))))
+    return max(1.0, np.ceil(furthest*2)/2)
+
+def renderPoints(x, y):
+    fig, axes = newFigure()
+    axes.plot(x, y, '.k')
+    return toPng(fig)
+
+def renderDensity(x, y):
+    fig, axes = newFigure()
+    limit = getLimit(x, y)
+    counts, xEdges, yEdges = np.histogram2d(x, y, bins=densityBins, range=[[-limit, limit], [-limit, limit]])
+    # Log scale, so the rarely visited edges of the envelope still show next to the dense middle
+    shading = np.ma.masked_equal(np.log1p(counts.T), 0)
+    image = axes.imshow(shading, origin='lower', extent=(-limit, limit, -limit, limit), cmap='viridis', interpolation='nearest')
+    fig.colorbar(image, ax=axes, label="log(1 + samples)")
+    axes.set_aspect('equal')
+    return toPng(fig)
+
+def render(x, y, style):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if "density" == style:
+        return renderDensity(x, y)
+    if "points" == style:
+        return renderPoints(x, y)
+    raise ValueError("Unknown G-G plot style: "+str(style))
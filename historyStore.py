@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+
+# History store: every session imported, with its lap and segment times, in one SQLite database, so
+# records across many sessions ("best segment 4 time at VIR in 2026") are a query instead of a reparse
+# of every data file.
+#
+# Sessions are identified like session cache entries - by the hash of the data file's content and the
+# import options - and keep their provenance: the file they were first read from, the content hash, the
+# importer version and when they were added. The files table remembers the size and modification time
+# of every data file seen, so unchanged files are recognised without reading them again, and the
+# sheets table the fingerprint of what was last written to each spreadsheet sheet. A fingerprint only
+# counts while the workbook is as it was saved - edit the workbook elsewhere and its sheets are
+# written again.
+# Laps and segments carry their session's track and start time, so the record queries are answered
+# from one index each. The analytics table holds the saved trackAnalytics accumulators.
+
+import json
+import os, os.path
+import sqlite3
+from datetime import datetime
+import numpy as np
+import dataImporter
+import utils
+from datamodel import lookupSessionInfo
+from sessionCache import hashFile, getOptions
+
+defaultDatabase = os.path.join(os.path.expanduser("~"), ".local", "share", "PyRDA", "history.sqlite3")
+
+schema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    contentHash TEXT NOT NULL,
+    options TEXT NOT NULL,
+    sourceFile TEXT NOT NULL,
+    importerVersion INTEGER NOT NULL,
+    importedAt TEXT NOT NULL,
+    trackId TEXT,
+    trackName TEXT,
+    driverName TEXT,
+    vehicle TEXT,
+    sessionStart TEXT,
+    numLaps INTEGER NOT NULL,
+    sessioninfo TEXT NOT NULL,
+    UNIQUE (contentHash, options)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtimeNs INTEGER NOT NULL,
+    contentHash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS laps (
+    sessionId INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    lap INTEGER NOT NULL,
+    hot INTEGER NOT NULL,
+    trackId TEXT,
+    sessionStart TEXT,
+    lapTime REAL NOT NULL,
+    PRIMARY KEY (sessionId, lap)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    sessionId INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    lap INTEGER NOT NULL,
+    segment INTEGER NOT NULL,
+    hot INTEGER NOT NULL,
+    trackId TEXT,
+    sessionStart TEXT,
+    segmentTime REAL NOT NULL,
+    PRIMARY KEY (sessionId, lap, segment)
+);
+CREATE TABLE IF NOT EXISTS sheets (
+    workbook TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    workbookStamp TEXT NOT NULL,
+    PRIMARY KEY (workbook, sheet)
+);
+CREATE TABLE IF NOT EXISTS analytics (
+    trackId TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lapsByTrack ON laps (trackId, hot, sessionStart, lapTime);
+CREATE INDEX IF NOT EXISTS segmentsByTrack ON segments (trackId, segment, hot, sessionStart, segmentTime);
+"""
+
+# The session start as an ISO date and time (sortable, and comparable to '2026-01-01'), if the file has one
+def getSessionStart(sessioninfo):
+    try:
+        start = datetime.strptime(sessioninfo["sessionDate"]+" "+sessioninfo["sessionTime"], "%A, %B %d, %Y %I:%M %p")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return start.isoformat()
+
+# SQL conditions (and their parameters) limiting a query to sessions started in [since, until)
+def getDateConditions(since, until):
+    conditions = ""
+    params = []
+    if since is not None:
+        conditions += " AND sessionStart >= ?"
+        params.append(since)
+    if until is not None:
+        conditions += " AND sessionStart < ?"
+        params.append(until)
+    return conditions, params
+
+# A session as read back from the store: its metadata and lap times, with the SessionSummary methods
+# the spreadsheet uses
+class SessionRecord:
+    def __init__(self, sessionId, sourceFile, contentHash, sessioninfo, lapTimes):
+        self.sessionId = sessionId
+        self.sourceFile = sourceFile
+        self.contentHash = contentHash
+        self.sessioninfo = sessioninfo
+        self.lapTimes = lapTimes
+
+    def getSessionInfo(self, item):
+        return lookupSessionInfo(self.sessioninfo, item)
+
+    def getLapTimes(self):
+        return list(self.lapTimes)
+
+    def getHotLapTimes(self):
+        return self.lapTimes[1:-1]
+
+class HistoryStore:
+    def __init__(self, path=None):
+        self.path = path or defaultDatabase
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Worker processes may be adding sessions at the same time - wait for each other's writes
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    # Content hash of a data file, read again only when the file has changed since it was last seen
+    def getContentHash(self, filename):
+        path = os.path.abspath(filename)
+        info = os.stat(path)
+        row = self.db.execute("SELECT contentHash FROM files WHERE path = ? AND size = ? AND mtimeNs = ?",
+                              (path, info.st_size, info.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        contentHash = hashFile(path).hexdigest()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtimeNs, contentHash) VALUES (?, ?, ?, ?)",
+                            (path, info.st_size, info.st_mtime_ns, contentHash))
+        return contentHash
+
+    # The stored session for a data file imported with these options, or None
+    def findSession(self, filename, args, trim):
+        row = self.db.execute("SELECT id FROM sessions WHERE contentHash = ? AND options = ?",
+                              (self.getContentHash(filename), getOptions(args, trim))).fetchone()
+        return None if row is None else row[0]
+
+    # Store a session (a TrackSession or its SessionSummary) imported from a data file. Returns its id;
+    # a session that is already stored is left as it is.
+    def addSession(self, filename, args, trim, session):
+        contentHash = self.getContentHash(filename)
+        options = getOptions(args, trim)
+        sessioninfo = dict(session.sessioninfo)
+        sessionStart = getSessionStart(sessioninfo)
+        trackId = sessioninfo.get("trackId")
+        lapTimes = session.getLapTimes()
+        summary = session.getSummary() if hasattr(session, "getSummary") else session
+        with self.db:
+            cursor = self.db.execute("INSERT OR IGNORE INTO sessions (contentHash, options, sourceFile, importerVersion, importedAt, "
+                                     "trackId, trackName, driverName, vehicle, sessionStart, numLaps, sessioninfo) "
+                                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (contentHash, options, os.path.abspath(filename), dataImporter.IMPORTER_VERSION,
+                                      datetime.now().isoformat(timespec="seconds"), trackId, sessioninfo.get("trackName"),
+                                      sessioninfo.get("driverName"), sessioninfo.get("vehicle"), sessionStart,
+                                      len(lapTimes), json.dumps(sessioninfo)))
+            if 0 == cursor.rowcount:
+                return self.findSession(filename, args, trim)
+            sessionId = cursor.lastrowid
+            # The hot laps are all but the out lap and the in lap, as in the report
+            hot = [1 if 0 < lap < len(lapTimes)-1 else 0 for lap in range(len(lapTimes))]
+            self.db.executemany("INSERT INTO laps (sessionId, lap, hot, trackId, sessionStart, lapTime) VALUES (?, ?, ?, ?, ?, ?)",
+                                [(sessionId, lap, hot[lap], trackId, sessionStart, lapTime) for lap, lapTime in enumerate(lapTimes)])
+            self.db.executemany("INSERT INTO segments (sessionId, lap, segment, hot, trackId, sessionStart, segmentTime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(sessionId, lap, segNum, hot[lap], trackId, sessionStart, segTime)
+                                 for segNum, segment in summary.segments.items()
+                                 for lap, segTime in enumerate(segment.times)])
+        return sessionId
+
+    # Stored session ids for data files, in the same order. Files not stored yet are imported with
+    # summarize(filename) -> SessionSummary, run on a pool of jobs worker processes (each started with
+    # initializer(*initargs)).
+    def ingestFiles(self, files, args, trim, summarize, jobs=1, initializer=None, initargs=()):
+        sessionIds = [self.findSession(filename, args, trim) for filename in files]
+        newFiles = [filename for filename, sessionId in zip(files, sessionIds) if sessionId is None]
+        if 0 < len(newFiles):
+            newIds = iter([self.addSession(filename, args, trim, summary)
+                           for filename, summary in zip(newFiles, utils.parallelMap(summarize, newFiles, jobs, initializer=initializer, initargs=initargs))])
+            sessionIds = [next(newIds) if sessionId is None else sessionId for sessionId in sessionIds]
+        return sessionIds
+
+    def getSession(self, sessionId):
+        sourceFile, contentHash, sessioninfo = self.db.execute("SELECT sourceFile, contentHash, sessioninfo FROM sessions WHERE id = ?",
+                                                               (sessionId,)).fetchone()
+        lapTimes = [row[0] for row in self.db.execute("SELECT lapTime FROM laps WHERE sessionId = ? ORDER BY lap", (sessionId,))]
+        return SessionRecord(sessionId, sourceFile, contentHash, json.loads(sessioninfo), lapTimes)
+
+    def getWorkbookStamp(self, workbook):
+        info = os.stat(workbook)
+        return str(info.st_size)+":"+str(info.st_mtime_ns)
+
+    def getSheetFingerprint(self, workbook, sheet):
+        row = self.db.execute("SELECT fingerprint, workbookStamp FROM sheets WHERE workbook = ? AND sheet = ?",
+                              (os.path.abspath(workbook), sheet)).fetchone()
+        if row is None or row[1] != self.getWorkbookStamp(workbook):
+            return None
+        return row[0]
+
+    # Record the sheets just written to a workbook. The sheets left alone are still up to date if they
+    # were before the save (when the workbook stamp was previousStamp).
+    def setSheetFingerprints(self, workbook, previousStamp, fingerprints):
+        workbookPath = os.path.abspath(workbook)
+        stamp = self.getWorkbookStamp(workbook)
+        with self.db:
+            self.db.execute("UPDATE sheets SET workbookStamp = ? WHERE workbook = ? AND workbookStamp = ?",
+                            (stamp, workbookPath, previousStamp))
+            self.db.executemany("INSERT OR REPLACE INTO sheets (workbook, sheet, fingerprint, workbookStamp) VALUES (?, ?, ?, ?)",
+                                [(workbookPath, sheet, fingerprint, stamp) for sheet, fingerprint in fingerprints.items()])
+
+    # Record queries. since / until are ISO dates or datetimes ('2026-01-01', until exclusive); only hot
+    # laps count, and empty segments (no time recorded) are skipped. Each returns (time, session id, lap)
+    # or None.
+    def getBestLap(self, trackId, since=None, until=None):
+        dates, params = getDateConditions(since, until)
+        return self.db.execute("SELECT lapTime, sessionId, lap FROM laps WHERE trackId = ? AND hot = 1"+dates+
+                               " AND lapTime > 0 ORDER BY lapTime LIMIT 1", [trackId] + params).fetchone()
+
+    def getBestSegment(self, trackId, segment, since=None, until=None):
+        dates, params = getDateConditions(since, until)
+        return self.db.execute("SELECT segmentTime, sessionId, lap FROM segments WHERE trackId = ? AND segment = ? AND hot = 1"+dates+
+                               " AND segmentTime > 0 ORDER BY segmentTime LIMIT 1", [trackId, segment] + params).fetchone()
+
+    # Hot lap and segment times at a track from the sessions stored after afterSessionId and started in
+    # [since, until), as arrays of (session id, lap, lap time) and (session id, lap, segment, segment time)
+    # rows, plus the sessions' start times. A data file stored more than once (imported with different
+    # options) counts once, as the first session stored from it.
+    def getHotTimes(self, trackId, afterSessionId=0, since=None, until=None):
+        dates, params = getDateConditions(since, until)
+        firstSessions = " AND sessionId IN (SELECT MIN(id) FROM sessions WHERE trackId = ? GROUP BY contentHash)"
+        laps = self.db.execute("SELECT sessionId, lap, lapTime FROM laps WHERE trackId = ? AND hot = 1 AND lapTime > 0 AND sessionId > ?"+
+                               dates+firstSessions, [trackId, afterSessionId] + params + [trackId]).fetchall()
+        segments = self.db.execute("SELECT sessionId, lap, segment, segmentTime FROM segments WHERE trackId = ? AND hot = 1 "
+                                   "AND segmentTime > 0 AND sessionId > ?"+dates+firstSessions,
+                                   [trackId, afterSessionId] + params + [trackId]).fetchall()
+        starts = dict(self.db.execute("SELECT id, sessionStart FROM sessions WHERE trackId = ? AND id > ?", (trackId, afterSessionId)))
+        return np.array(laps, dtype=float).reshape(-1, 3), np.array(segments, dtype=float).reshape(-1, 4), starts
+
+    def getAnalyticsState(self, trackId):
+        row = self.db.execute("SELECT state FROM analytics WHERE trackId = ?", (trackId,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def setAnalyticsState(self, trackId, state):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO analytics (trackId, state) VALUES (?, ?)", (trackId, json.dumps(state)))
+
+    # Best lap and best time for every segment on record at a track, for the report
+    def getTrackRecords(self, trackId):
+        # A data file stored more than once (imported with different options) is one session
+        records = {"sessions": self.db.execute("SELECT COUNT(DISTINCT contentHash) FROM sessions WHERE trackId = ?", (trackId,)).fetchone()[0],
+                   "lap": None, "segments": {}}
+        best = self.getBestLap(trackId)
+        if best is not None:
+            records["lap"] = {"time": best[0], "date": self.getSession(best[1]).getSessionInfo("sessionDate")}
+        for segment, segmentTime in self.db.execute("SELECT segment, MIN(segmentTime) FROM segments WHERE trackId = ? AND hot = 1 "
+                                                    "AND segmentTime > 0 GROUP BY segment", (trackId,)):
+            records["segments"][segment] = segmentTime
+        return records
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# A static 2-D KD-tree over points in feet (e.g. utils.projectLocal() output), in NumPy.
+#
+# The tree is built once by splitting the points at the median of the wider side of their bounding box
+# until at most leafSize are left. Nodes are kept in flat arrays: the [start, stop) range of each node
+# in self.order (the point indexes, rearranged so every node's points are contiguous), its bounding box,
+# the lowest and highest point index under it and its two children. Queries only visit the nodes whose
+# boxes (and, for nearest() limited to an index range, whose index ranges) can hold an answer - O(log N)
+# of them for a nearest-point or small-area query - and test the points of a leaf in one vectorized step.
+# Nodes split by area, so near a spot every lap passes the index ranges still span most of the session;
+# for queries limited to one lap, build a tree over that lap's points instead.
+
+import heapq
+import numpy as np
+
+class KDTree:
+    def __init__(self, points, leafSize=32):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.order = np.arange(len(self.points))
+        starts = []
+        stops = []
+        boxes = []
+        indexRanges = []
+        children = []
+
+        def addNode(start, stop):
+            starts.append(start)
+            stops.append(stop)
+            boxes.append(None)
+            indexRanges.append(None)
+            children.append(None)
+            return len(starts) - 1
+
+        pending = [addNode(0, len(self.points))] if 0 < len(self.points) else []
+        while pending:
+            node = pending.pop()
+            start, stop = starts[node], stops[node]
+            nodePoints = self.points[self.order[start:stop]]
+            low = nodePoints.min(axis=0)
+            high = nodePoints.max(axis=0)
+            boxes[node] = (low[0], low[1], high[0], high[1])
+            nodeIndexes = self.order[start:stop]
+            indexRanges[node] = (int(nodeIndexes.min()), int(nodeIndexes.max()))
+            if stop - start <= leafSize:
+                continue
+            dim = int(np.argmax(high - low))
+            mid = (start + stop) // 2
+            split = np.argpartition(nodePoints[:, dim], mid - start)
+            self.order[start:stop] = self.order[start:stop][split]
+            children[node] = (addNode(start, mid), addNode(mid, stop))
+            pending.extend(children[node])
+
+        self.starts = starts
+        self.stops = stops
+        self.boxes = boxes
+        self.indexRanges = indexRanges
+        self.children = children
+
+    def __len__(self):
+        return len(self.points)
+
+    # Squared distance from (x, y) to a node's bounding box - 0 inside it
+    def boxDistance2(self, node, x, y):
+        minX, minY, maxX, maxY = self.boxes[node]
+        dx = max(minX - x, 0.0, x - maxX)
+        dy = max(minY - y, 0.0, y - maxY)
+        return dx*dx + dy*dy
+
+    # Whether any point under a node has an index in [start, stop)
+    def overlapsRange(self, node, start, stop):
+        lowest, highest = self.indexRanges[node]
+        return lowest < stop and highest >= start
+
+    # Index of the point nearest xy and its distance, considering only the points with indexes in
+    # [start, stop) when those are given. (None, inf) if there is no such point.
+    def nearest(self, xy, start=None, stop=None):
+        x, y = float(xy[0]), float(xy[1])
+        bestIdx = None
+        bestDistance2 = np.inf
+        if 0 == len(self.starts) or (start is not None and not self.overlapsRange(0, start, stop)):
+            return bestIdx, np.inf
+        queue = [(0.0, 0)]
+        while queue:
+            distance2, node = heapq.heappop(queue)
+            if distance2 >= bestDistance2:
+                break
+            if self.children[node] is None:
+                indexes = self.order[self.starts[node]:self.stops[node]]
+                if start is not None:
+                    indexes = indexes[(indexes >= start) & (indexes < stop)]
+                    if 0 == len(indexes):
+                        continue
+                offsets = self.points[indexes] - (x, y)
+                distances2 = np.einsum('ij,ij->i', offsets, offsets)
+                closest = int(np.argmin(distances2))
+                if distances2[closest] < bestDistance2:
+                    bestDistance2 = float(distances2[closest])
+                    bestIdx = int(indexes[closest])
+            else:
+                for child in self.children[node]:
+                    if start is not None and not self.overlapsRange(child, start, stop):
+                        continue
+                    childDistance2 = self.boxDistance2(child, x, y)
+                    if childDistance2 < bestDistance2:
+                        heapq.heappush(queue, (childDistance2, child))
+        return bestIdx, float(np.sqrt(bestDistance2))
+
+    # Sorted indexes of the points within radius of xy
+    def withinRadius(self, xy, radius):
+        x, y = float(xy[0]), float(xy[1])
+        radius2 = radius*radius
+        found = []
+        pending = [0] if 0 < len(self.starts) else []
+        while pending:
+            node = pending.pop()
+            if self.boxDistance2(node, x, y) > radius2:
+                continue
+            if self.children[node] is None:
+                indexes = self.order[self.starts[node]:self.stops[node]]
+                offsets = self.points[indexes] - (x, y)
+                found.append(indexes[np.einsum('ij,ij->i', offsets, offsets) <= radius2])
+            else:
+                pending.extend(self.children[node])
+        return np.sort(np.concatenate(found)) if found else np.zeros(0, dtype=int)
+
+    # Sorted indexes of the points inside the box low..high (both (x, y))
+    def inBox(self, low, high):
+        found = []
+        pending = [0] if 0 < len(self.starts) else []
+        while pending:
+            node = pending.pop()
+            minX, minY, maxX, maxY = self.boxes[node]
+            if maxX < low[0] or minX > high[0] or maxY < low[1] or minY > high[1]:
+                continue
+            indexes = self.order[self.starts[node]:self.stops[node]]
+            # Wholly inside: every point is in, nothing to test
+            if minX >= low[0] and maxX <= high[0] and minY >= low[1] and maxY <= high[1]:
+                found.append(indexes)
+            elif self.children[node] is None:
+                nodePoints = self.points[indexes]
+                inside = np.all((nodePoints >= low) & (nodePoints <= high), axis=1)
+                found.append(indexes[inside])
+            else:
+                pending.extend(self.children[node])
+        return np.sort(np.concatenate(found)) if found else np.zeros(0, dtype=int)
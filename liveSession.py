@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# Live session mode: lap and segment times in the pit box while the session is still running.
+# Follows a data file as the logger export grows (or reads a FIFO the export is written to), adds each
+# sample to a TrackSession as it arrives and runs lap and segment detection one sample at a time.
+# Completed laps and segments are published as JSON lines on stdout and, with --publish-port, to every
+# client connected to a local TCP port.
+
+import asyncio
+import argparse
+import csv
+import json
+import os, stat
+from operator import itemgetter
+import numpy as np
+from dataImporter import getImporterFor
+
+parser = argparse.ArgumentParser(description='Show lap and segment times from a track data file as it is being written')
+parser.add_argument('-f', '--file', action='store', required=True, help='Data file (or FIFO) the logger is writing to')
+parser.add_argument('-v', '--verbose', action='count', default=0)
+parser.add_argument('-t', '--trackname', action='store', help='Name of track data is from, if not present in file (e.g. TrackAddict data). Without it, the track is recognised from the GPS data.')
+parser.add_argument('--gps-only', action=argparse.BooleanOptionalAction, help='Data has GPS channels only (e.g. AIM Solo 2 non-DL data)', default=False)
+parser.add_argument('--publish-port', type=int, help='Also publish lap and segment events to clients connecting to this local TCP port')
+parser.add_argument('--poll-interval', type=float, default=0.02, help='Seconds between checks for new data in a growing file')
+parser.add_argument('--idle-timeout', type=float, default=60.0, help='Consider the session over when a growing file has not changed for this many seconds')
+
+# Set by main()
+args = None
+
+# Same rule as TrackSession.assignLapsAndSegments(), applied as each sample arrives: a waypoint is
+# crossed on the first sample that moves away from it while within crossingRadius feet of it. Only the
+# distance to the waypoint being looked for is computed, so every sample costs the same however long
+# the session has run. Lap and segment times are measured the way the batch code measures them, from
+# the first to the last sample of the lap or segment.
+crossingRadius = 50
+
+class LiveLapDetector:
+    def __init__(self, track, publish):
+        self.track = track
+        self.publish = publish
+        self.target = 0
+        self.previousDistance = None
+        self.numSamples = 0
+        self.lastTime = None
+        # Laps are numbered like the report's lap list: lap 0 runs from the first sample
+        self.lap = 0
+        self.lapStartTime = None
+        self.segment = 0
+        self.segmentStart = 0
+        self.segmentStartTime = None
+        self.lapTimes = []
+
+    def distanceToTarget(self, position):
+        return float(self.track.distances(position, self.track.targetsXY[self.target])[0, 0])
+
+    def addSample(self, sampleTime, lat, lng):
+        idx = self.numSamples
+        position = np.array([[lat, lng]])
+        if self.lapStartTime is None:
+            self.lapStartTime = self.segmentStartTime = sampleTime
+        distance = self.distanceToTarget(position)
+        if self.previousDistance is not None and distance > self.previousDistance and crossingRadius > distance:
+            self.crossed(idx, sampleTime)
+            # Look for the next waypoint from this sample on
+            distance = self.distanceToTarget(position)
+        self.previousDistance = distance
+        self.lastTime = sampleTime
+        self.numSamples += 1
+
+    def crossed(self, idx, sampleTime):
+        if 0 == self.target:
+            self.publish({"event": "trackEntered", "lap": self.lap, "time": sampleTime})
+            self.segment = 1
+            self.target = 1
+        else:
+            segmentTime = self.lastTime - self.segmentStartTime if idx - self.segmentStart > 1 else 0.0
+            self.publish({"event": "segment", "lap": self.lap, "segment": self.segment, "segmentTime": segmentTime})
+            if self.track.targets[self.target] == self.track.startpoint:
+                lapTime = self.lastTime - self.lapStartTime
+                self.lapTimes.append(lapTime)
+                self.publish({"event": "lap", "lap": self.lap, "lapTime": lapTime, "bestLapTime": min(self.lapTimes)})
+                self.lap += 1
+                self.lapStartTime = sampleTime
+                self.segment = 1
+                self.target = 1
+            else:
+                self.segment += 1
+                self.target += 1
+        self.segmentStart = idx
+        self.segmentStartTime = sampleTime
+
+# Complete lines of a file as they are written. A FIFO is read until the writer closes it; a regular
+# file is polled until it stops growing for --idle-timeout seconds.
+async def followLines(filename):
+    loop = asyncio.get_running_loop()
+    if stat.S_ISFIFO(os.stat(filename).st_mode):
+        reader = asyncio.StreamReader()
+        # Opening a FIFO blocks until there is a writer
+        pipe = await loop.run_in_executor(None, open, filename, "rb", 0)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line.decode()
+    else:
+        with open(filename, "r", newline='') as fileHandle:
+            partial = ""
+            idleSince = loop.time()
+            while True:
+                line = fileHandle.readline()
+                if not line:
+                    if loop.time() - idleSince > args.idle_timeout:
+                        return
+                    await asyncio.sleep(args.poll_interval)
+                    continue
+                idleSince = loop.time()
+                # The writer may be part way through a line
+                if not line.endswith("\n"):
+                    partial += line
+                    continue
+                yield partial + line
+                partial = ""
+
+# Sends each event to every connected client as a JSON line
+class EventServer:
+    def __init__(self):
+        self.writers = set()
+        self.server = None
+
+    async def start(self, port):
+        self.server = await asyncio.start_server(self.connected, "127.0.0.1", port)
+
+    async def connected(self, reader, writer):
+        self.writers.add(writer)
+
+    def publish(self, event):
+        line = (json.dumps(event)+"\n").encode()
+        for writer in list(self.writers):
+            if writer.is_closing():
+                self.writers.discard(writer)
+            else:
+                writer.write(line)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+
+class LiveSession:
+    def __init__(self, filename, callbacks):
+        self.filename = filename
+        self.callbacks = callbacks
+        self.session = None
+        self.detector = None
+        # Samples that arrived before the track was known - only while waiting for GPS fixes to
+        # recognise it from
+        self.waiting = []
+
+    def publish(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def readHeaders(self, importer, headerLines):
+        self.session = importer.session
+        self.skipComments = importer.skipComments
+        reader = csv.reader(headerLines)
+        if hasattr(importer, "readMetadata"):
+            importer.readMetadata(reader)
+        if args.trackname:
+            self.session.addSessionInfo(trackName = args.trackname)
+        self.session.loadTrack(args)
+        columns = importer.getChannelColumns(importer.readColumnHeaders(reader), args)
+        self.names = [name for name, idx in columns]
+        self.getter = itemgetter(*[idx for name, idx in columns])
+        self.latIdx = self.names.index("GPSlat")
+        self.lngIdx = self.names.index("GPSlng")
+
+    def startDetector(self):
+        self.detector = LiveLapDetector(self.session.track, self.publish)
+        self.publish({"event": "trackFound", "track": self.session.track.description})
+        for values in self.waiting:
+            self.detector.addSample(values[0], values[self.latIdx], values[self.lngIdx])
+        self.waiting = []
+
+    def addRow(self, row):
+        if 0 == len(row) or (self.skipComments and row[0].startswith('#')):
+            return
+        values = [float(v) for v in self.getter(row)]
+        self.session.addMeasurement(values[0], **dict(zip(self.names[1:], values[1:])))
+        if self.detector is not None:
+            self.detector.addSample(values[0], values[self.latIdx], values[self.lngIdx])
+            return
+        self.waiting.append(values)
+        if self.session.track is None and len(self.waiting) % 10 == 0:
+            self.session.matchTrack(args)
+        if self.session.track is not None:
+            self.startDetector()
+
+    async def run(self):
+        importer = None
+        headerLines = []
+        async for line in followLines(self.filename):
+            if self.session is not None:
+                self.addRow(next(csv.reader([line])))
+                continue
+            if importer is None:
+                importer = getImporterFor(line, self.filename)
+                if not importer:
+                    raise ValueError("Unknown data file format: "+self.filename)
+            headerLines.append(line)
+            if importer.isHeaderComplete(headerLines):
+                self.readHeaders(importer, headerLines)
+                if self.session.track is not None:
+                    self.startDetector()
+
+        # The session is over: the whole-session detection gives the same laps, and the session is
+        # ready for anything else that wants it
+        if self.session is not None and self.session.track is not None:
+            self.session.assignLapsAndSegments(args)
+            self.publish({"event": "sessionEnd", "laps": self.session.numLaps, "lapTimes": self.session.getLapTimes()})
+        return self.session
+
+def printEvent(event):
+    print(json.dumps(event), flush=True)
+
+async def runLive():
+    callbacks = [printEvent]
+    server = None
+    if args.publish_port:
+        server = EventServer()
+        await server.start(args.publish_port)
+        callbacks.append(server.publish)
+    try:
+        await LiveSession(args.file, callbacks).run()
+    finally:
+        if server is not None:
+            server.close()
+
+def main(argv=None):
+    global args
+    args = parser.parse_args(argv)
+    asyncio.run(runLive())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+# Map image rendering for the report.
+# Two backends draw the same maps:
+#   folium - a Leaflet map over Esri satellite tiles, turned into a PNG by a headless browser. Needs
+#            network access and takes a few seconds per image.
+#   local  - projects the traces to pixels (Web Mercator, like the tile maps) and draws them directly
+#            with PIL, optionally over a local basemap image. No browser, no network.
+# Both take points as [lat, lng] pairs and bounds as [southWest, northEast], like folium does.
+# MapSpec records the same calls without drawing anything, so a map can be described in one process
+# and rendered in another.
+
+import io
+import numpy as np
+from PIL import Image, ImageDraw
+import utils
+
+tileUrl = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+tileAttribution = "Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community"
+
+# Part of every map image's artifact cache key - bump when the images change for the same MapSpec
+RENDERER_VERSION = 1
+
+# Leaflet's default path color
+defaultColor = "#3388ff"
+# Local backend background where there is no basemap
+backgroundColor = "#e8e4dc"
+
+# A map described but not yet drawn. Points are kept as arrays so a spec is cheap to send to a worker.
+class MapSpec:
+    def __init__(self, location, zoom=15):
+        self.location = location
+        self.zoom = zoom
+        self.bounds = None
+        self.layers = []
+
+    def fitBounds(self, bounds):
+        self.bounds = bounds
+
+    def addPolyline(self, points, color=None, smoothFactor=None):
+        self.layers.append(("polyline", np.asarray(points, dtype=float), color, smoothFactor))
+
+    def addMarkers(self, points, color, radius=1):
+        self.layers.append(("markers", np.asarray(points, dtype=float), color, radius))
+
+    # Everything that goes into the image, for artifact cache keys
+    def getKeyParts(self):
+        return [self.location, self.zoom, self.bounds, self.layers]
+
+    def render(self, backend, basemap=None):
+        renderMap = newMap(backend, self.location, self.zoom, basemap)
+        for kind, points, color, option in self.layers:
+            if "polyline" == kind:
+                renderMap.addPolyline(points, color, option)
+            else:
+                renderMap.addMarkers(points, color, option)
+        if self.bounds is not None:
+            renderMap.fitBounds(self.bounds)
+        return renderMap.toPng()
+
+# Ground distance in feet covered by one pixel of a map image fitted to bounds by the backend. Traces are
+# simplified to a fraction of this before they go on a map - detail finer than a pixel can't be seen anyway.
+def feetPerPixel(bounds, backend="local"):
+    mapClass = getMapClass(backend)
+    southWest, northEast = bounds
+    east, north = np.abs(utils.projectLocal([northEast], southWest)[0])
+    width = mapClass.imageSize[0] - 2*mapClass.padding
+    height = mapClass.imageSize[1] - 2*mapClass.padding
+    return max(east / width, north / height)
+
+def getMapClass(backend):
+    if "local" == backend:
+        return LocalMap
+    if "folium" == backend:
+        return FoliumMap
+    raise ValueError("Unknown map backend: "+str(backend))
+
+def newMap(backend, location, zoom=15, basemap=None):
+    if "local" == backend:
+        return LocalMap(location, zoom, basemap)
+    return getMapClass(backend)(location, zoom)
+
+class FoliumMap:
+    # The screenshot is of the map filling a full screen headless Firefox window, and Leaflet's
+    # fitBounds() leaves no padding
+    imageSize = (1366, 768)
+    padding = 0
+
+    def __init__(self, location, zoom=15):
+        import folium
+        self.folium = folium
+        self.map = folium.Map(location=location, zoom_start=zoom, tiles=tileUrl, attr=tileAttribution)
+
+    def fitBounds(self, bounds):
+        self.map.fit_bounds(bounds)
+
+    def addPolyline(self, points, color=None, smoothFactor=None):
+        options = {}
+        if color is not None:
+            options["color"] = color
+        if smoothFactor is not None:
+            options["smooth_factor"] = smoothFactor
+        self.folium.PolyLine(np.asarray(points).tolist(), **options).add_to(self.map)
+
+    def addMarkers(self, points, color, radius=1):
+        for point in np.asarray(points).tolist():
+            self.folium.CircleMarker(location=point, radius=radius, color=color).add_to(self.map)
+
+    def toPng(self):
+        return self.map._to_png(3)
+
+# Spherical (Web) Mercator, in units of the whole world: x and y both run 0..1.
+# Works on single values and on arrays.
+def mercator(lat, lng):
+    x = (np.asarray(lng) + 180.0) / 360.0
+    sinLat = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sinLat) / (1 - sinLat)) / (4 * np.pi)
+    return x, y
+
+# A north-up image covering a known lat/lng box - e.g. an export of satellite tiles for the track
+class Basemap:
+    def __init__(self, filename, bounds):
+        self.image = Image.open(filename).convert("RGB")
+        south, west, north, east = bounds
+        self.left, self.top = [float(v) for v in mercator(north, west)]
+        self.right, self.bottom = [float(v) for v in mercator(south, east)]
+
+    # The part of the basemap under a view, resampled to the view size
+    def render(self, size, left, top, right, bottom):
+        width, height = self.image.size
+        scaleX = width / (self.right - self.left)
+        scaleY = height / (self.bottom - self.top)
+        box = ((left - self.left) * scaleX, (top - self.top) * scaleY,
+               (right - self.left) * scaleX, (bottom - self.top) * scaleY)
+        return self.image.transform(size, Image.Transform.EXTENT, box, Image.Resampling.BILINEAR, fillcolor=backgroundColor)
+
+class LocalMap:
+    imageSize = (800, 600)
+    # Drawn at this multiple of the output size and scaled down, for smooth lines
+    supersample = 2
+    padding = 20
+    lineWidth = 3
+
+    def __init__(self, location, zoom=15, basemap=None):
+        self.basemap = basemap
+        self.centerX, self.centerY = [float(v) for v in mercator(location[0], location[1])]
+        self.scale = 256 * 2**zoom
+        self.lines = []
+        self.markers = []
+
+    def fitBounds(self, bounds):
+        (lat1, lng1), (lat2, lng2) = bounds
+        left, top = [float(v) for v in mercator(max(lat1, lat2), min(lng1, lng2))]
+        right, bottom = [float(v) for v in mercator(min(lat1, lat2), max(lng1, lng2))]
+        self.centerX = (left + right) / 2
+        self.centerY = (top + bottom) / 2
+        width = self.imageSize[0] - 2*self.padding
+        height = self.imageSize[1] - 2*self.padding
+        spanX = max(right - left, 1e-12)
+        spanY = max(bottom - top, 1e-12)
+        self.scale = min(width / spanX, height / spanY)
+
+    def addPolyline(self, points, color=None, smoothFactor=None):
+        self.lines.append((points, color or defaultColor))
+
+    def addMarkers(self, points, color, radius=1):
+        self.markers.append((points, color, radius))
+
+    def toPixels(self, points, factor):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        width, height = self.imageSize
+        x, y = mercator(points[:, 0], points[:, 1])
+        pixelX = (width/2 + (x - self.centerX)*self.scale) * factor
+        pixelY = (height/2 + (y - self.centerY)*self.scale) * factor
+        return list(zip(pixelX.tolist(), pixelY.tolist()))
+
+    def toPng(self):
+        factor = self.supersample
+        size = (self.imageSize[0]*factor, self.imageSize[1]*factor)
+        if self.basemap is None:
+            image = Image.new("RGB", size, backgroundColor)
+        else:
+            halfWidth = self.imageSize[0] / 2 / self.scale
+            halfHeight = self.imageSize[1] / 2 / self.scale
+            image = self.basemap.render(size, self.centerX - halfWidth, self.centerY - halfHeight,
+                                        self.centerX + halfWidth, self.centerY + halfHeight)
+        draw = ImageDraw.Draw(image)
+        for points, color in self.lines:
+            pixels = self.toPixels(points, factor)
+            if len(pixels) > 1:
+                draw.line(pixels, fill=color, width=self.lineWidth*factor, joint="curve")
+        for points, color, radius in self.markers:
+            r = max(radius, 1) * factor * 1.5
+            for x, y in self.toPixels(points, factor):
+                draw.ellipse((x - r, y - r, x + r, y + r), outline=color, width=factor)
+        image = image.resize(self.imageSize, Image.Resampling.LANCZOS)
+        imgBuf = io.BytesIO()
+        image.save(imgBuf, format="png")
+        return imgBuf.getvalue()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+# Per-stage instrumentation for report runs: wall time, CPU time and peak memory of each stage of the
+# pipeline (import, trimming, segment work, every image, the template and the PDF conversion), written
+# with --profile as JSON or as a Chrome trace (chrome://tracing, Perfetto).
+#
+# Stages nest. Peak memory is the most the traced (Python and NumPy) allocations grew above what was
+# allocated when the stage started, nested stages included. It comes from tracemalloc, which slows the
+# run down noticeably - --no-profile-memory leaves it out.
+#
+# Nothing is recorded unless enable() has been called, and stage() is then a no-op context.
+# Worker processes record into their own copy of the profiler; collect() runs a function and hands
+# back its records with its result, so the parent can add them to its own with addRecords().
+
+import contextlib
+import json
+import os
+import platform
+import resource
+import threading
+import time
+import tracemalloc
+
+profiler = None
+
+class Profiler:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.records = []
+        self.stack = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, category="stage", **details):
+        frame = {"peak": 0, "base": 0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["base"] = frame["peak"] = current
+        self.stack.append(frame)
+        started = time.time()
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wallStart
+            cpu = time.process_time() - cpuStart
+            self.stack.pop()
+            record = {
+                "name": name,
+                "category": category,
+                "start": started,
+                "wall": wall,
+                "cpu": cpu,
+                "depth": len(self.stack),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "details": details,
+            }
+            if self.memory:
+                frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                record["peakMemory"] = frame["peak"] - frame["base"]
+                if self.stack:
+                    self.stack[-1]["peak"] = max(self.stack[-1]["peak"], frame["peak"])
+            self.records.append(record)
+
+def enable(memory=True):
+    global profiler
+    profiler = Profiler(memory)
+
+def isEnabled():
+    return profiler is not None
+
+def stage(name, category="stage", **details):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, category, **details)
+
+# Run func(*args) and return (result, the records made while it ran). The records are taken out of this
+# process's profiler - they belong to whoever called collect(), usually a parent process.
+def collect(func, *args):
+    if profiler is None:
+        return func(*args), []
+    saved = profiler.records
+    profiler.records = []
+    try:
+        result = func(*args)
+        return result, profiler.records
+    finally:
+        profiler.records = saved
+
+def addRecords(records):
+    if profiler is not None:
+        profiler.records.extend(records)
+
+def getRecords():
+    if profiler is None:
+        return []
+    return sorted(profiler.records, key=lambda record: record["start"])
+
+# Count, total wall and CPU seconds, and the largest peak memory of each stage name
+def getTotals(records):
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["name"], {"count": 0, "wall": 0.0, "cpu": 0.0})
+        total["count"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        if "peakMemory" in record:
+            total["peakMemory"] = max(total.get("peakMemory", 0), record["peakMemory"])
+    return totals
+
+def getProcessInfo():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "maxRSS": own.ru_maxrss*1024,
+        "childrenMaxRSS": children.ru_maxrss*1024,
+        "cpu": own.ru_utime + own.ru_stime,
+        "childrenCpu": children.ru_utime + children.ru_stime,
+    }
+
+def toJSON(records):
+    return {"process": getProcessInfo(), "totals": getTotals(records), "stages": records}
+
+# Complete ("X") events, one lane per process and thread, timestamps in microseconds from the first stage
+def toChromeTrace(records):
+    origin = min([record["start"] for record in records], default=0)
+    events = []
+    for record in records:
+        args = dict(record["details"])
+        args["cpu"] = record["cpu"]
+        if "peakMemory" in record:
+            args["peakMemory"] = record["peakMemory"]
+        events.append({
+            "name": record["name"],
+            "cat": record["category"],
+            "ph": "X",
+            "ts": (record["start"] - origin)*1e6,
+            "dur": record["wall"]*1e6,
+            "pid": record["pid"],
+            "tid": record["tid"],
+            "args": args,
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": getProcessInfo()}
+
+def write(filename, fileFormat="json"):
+    records = getRecords()
+    if "chrome" == fileFormat:
+        output = toChromeTrace(records)
+    else:
+        output = toJSON(records)
+    with open(filename, "w") as outFile:
+        json.dump(output, outFile, indent=1, default=str)
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# On-disk cache of fully processed sessions - channel arrays, lap ranges and lap/segment assignments,
+# and the session metadata - so unchanged data files are not parsed and lap-detected again on every run.
+#
+# Entries are keyed by a hash of the data file's content, the importer version and the options that
+# change the result (--gps-only, --trackname, trimming and --no-trim-tail). The track geometry is only
+# known once the file has been read, so it is stored in the entry instead and checked on load: edit a
+# track definition and the entries built with the old one are rebuilt automatically.
+# Each entry is a single NumPy .npz file. It also holds the Douglas-Peucker significance of every trace
+# drawn from the session so far (update() adds the new ones after a report), so maps at any zoom are
+# simplified without running Douglas-Peucker again in later runs.
+
+import hashlib
+import json
+import os, os.path
+import tempfile
+import numpy as np
+from datamodel import TrackSession
+import dataImporter
+import profiling
+import utils
+
+defaultCacheDir = os.path.join(os.path.expanduser("~"), ".cache", "PyRDA", "sessions")
+
+# SHA-256 of a file's content, as a hashlib object so more can be added to it
+def hashFile(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as dataFile:
+        for block in iter(lambda: dataFile.read(1 << 20), b""):
+            digest.update(block)
+    return digest
+
+# The options that change the session imported from a file, as a canonical string
+def getOptions(args, trim):
+    options = {
+        "importer": dataImporter.IMPORTER_VERSION,
+        "gps_only": bool(args.gps_only),
+        "trackname": args.trackname,
+        "trim": trim,
+        "no_trim_tail": bool(trim and args.no_trim_tail),
+    }
+    return json.dumps(options, sort_keys=True)
+
+class SessionCache:
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir or defaultCacheDir
+
+    # The channels kept depend on the analyses asked for, so they are part of the key too - the history
+    # store's options leave them out, as lap and segment times don't depend on them
+    def getKey(self, filename, args, trim):
+        digest = hashFile(filename)
+        digest.update(getOptions(args, trim).encode())
+        digest.update(json.dumps(sorted(dataImporter.getNeededChannels(args))).encode())
+        digest.update(str(utils.SIGNIFICANCE_VERSION).encode())
+        return digest.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key+".npz")
+
+    def store(self, key, session):
+        session.flush()
+        metadata = {
+            "sessioninfo": session.sessioninfo,
+            "channels": list(session.channels.keys()),
+            "lapRanges": session.lapRanges,
+            "untrimmedLapRanges": session.untrimmedLapRanges,
+            "trimBounds": session.trimBounds,
+            "numLaps": session.numLaps,
+            "trackFingerprint": session.getTrackFingerprint(),
+            "significance": [list(trace) for trace in session.traceSignificance.keys()],
+        }
+        arrays = {"channel_"+k: v for k, v in session.channels.items()}
+        for start, stop in session.traceSignificance.keys():
+            arrays[f"significance_{start}_{stop}"] = session.traceSignificance[(start, stop)]
+        arrays["metadata"] = np.array(json.dumps(metadata))
+        os.makedirs(self.cacheDir, exist_ok=True)
+        # Write under a temporary name and rename, so parallel workers never see half an entry
+        fd, tempName = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as entryFile:
+            np.savez_compressed(entryFile, **arrays)
+        os.replace(tempName, self.getPath(key))
+        session.storedSignificance = set(session.traceSignificance.keys())
+
+    def load(self, key, args):
+        path = self.getPath(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                metadata = json.loads(str(entry["metadata"]))
+                channels = {k: entry["channel_"+k] for k in metadata["channels"]}
+                significance = {(start, stop): entry[f"significance_{start}_{stop}"] for start, stop in metadata["significance"]}
+        except (OSError, ValueError, KeyError):
+            return None
+
+        session = TrackSession()
+        session.addSessionInfo(**metadata["sessioninfo"])
+        session.loadTrack(args)
+        if session.getTrackFingerprint() != metadata["trackFingerprint"]:
+            return None
+        session.channels = channels
+        session.numSamples = len(channels["time"])
+        session.lapRanges = metadata["lapRanges"]
+        session.untrimmedLapRanges = metadata["untrimmedLapRanges"]
+        if metadata["trimBounds"] is not None:
+            session.trimBounds = tuple(metadata["trimBounds"])
+        session.numLaps = metadata["numLaps"]
+        session.traceSignificance = significance
+        session.storedSignificance = set(significance.keys())
+        session.invalidateIndexes()
+        return session
+
+    # Cached stand-in for dataImporter.loadSession()
+    def loadSession(self, filename, args, trim=True):
+        with profiling.stage("sessionCache.load", file=filename):
+            key = self.getKey(filename, args, trim)
+            session = self.load(key, args)
+        if session is None:
+            if args.verbose:
+                print("Session cache miss: "+filename)
+            session = dataImporter.loadSession(filename, args, trim)
+            with profiling.stage("sessionCache.store", file=filename):
+                self.store(key, session)
+        elif args.verbose:
+            print("Session cache hit: "+filename)
+        # The same content can live under more than one name
+        session.addSessionInfo(sourcefile = filename)
+        return session
+
+    # Write a session loaded with loadSession() back to its entry if traces have been simplified since,
+    # so that their significance is kept for the next run
+    def update(self, filename, args, session, trim=True):
+        if set(session.traceSignificance.keys()) <= session.storedSignificance:
+            return
+        with profiling.stage("sessionCache.store", file=filename):
+            self.store(self.getKey(filename, args, trim), session)
@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+# Cross-session analytics for a track, over every session in the history store: the theoretical best
+# lap (the best time on record for each segment, added up), the distribution of each segment's times,
+# how consistent the laps have been from session to session, and which session and lap every best
+# came from.
+#
+# All of it is derived from a TrackAccumulator: counts, sums and sums of squares, the bests with their
+# session and lap, a histogram of each segment's times, and the moments of each session's hot laps.
+# Sessions are folded in with a few array operations, and never have to be looked at again - the
+# accumulator is saved in the history store, and each run only adds the sessions stored since the last.
+# As in the record queries, only hot laps count and segments without a time are skipped.
+#
+# Usage: trackAnalytics.py -t VIRfull [--since 2026-01-01] [--until 2027-01-01] [--window 5]
+
+import argparse
+import math
+import numpy as np
+import trackRegistry
+from historyStore import HistoryStore
+
+# Part of the saved state - bump when its layout changes, and the accumulators are rebuilt
+ANALYTICS_VERSION = 1
+# Width of the histogram bins segment time distributions are kept in, in seconds
+histogramBin = 0.01
+
+def newMoments():
+    return {"count": 0, "sum": 0.0, "sumSquares": 0.0, "best": None}
+
+# Add times (with the session id and lap of each) to a moments dict
+def addToMoments(moments, times, sessionIds, laps):
+    if 0 == len(times):
+        return
+    moments["count"] += int(len(times))
+    moments["sum"] += float(times.sum())
+    moments["sumSquares"] += float(np.dot(times, times))
+    fastest = int(np.argmin(times))
+    if moments["best"] is None or times[fastest] < moments["best"][0]:
+        moments["best"] = [float(times[fastest]), int(sessionIds[fastest]), int(laps[fastest])]
+
+def getMean(count, total):
+    return total / count if 0 < count else 0.0
+
+# Population standard deviation from the moments, like utils.stdDevFilter
+def getStdDev(count, total, sumSquares):
+    if 0 == count:
+        return 0.0
+    mean = total / count
+    return math.sqrt(max(sumSquares / count - mean*mean, 0.0))
+
+class TrackAccumulator:
+    def __init__(self, state=None):
+        if state is None or state.get("version") != ANALYTICS_VERSION:
+            state = {}
+        self.lastSessionId = state.get("lastSessionId", 0)
+        self.laps = state.get("laps", newMoments())
+        # JSON keys are strings
+        self.segments = {int(segment): moments for segment, moments in state.get("segments", {}).items()}
+        self.histograms = {int(segment): {int(b): n for b, n in histogram.items()}
+                           for segment, histogram in state.get("histograms", {}).items()}
+        # One [session id, session start, hot laps, sum, sum of squares] row per session
+        self.sessions = state.get("sessions", [])
+
+    def getState(self):
+        return {
+            "version": ANALYTICS_VERSION,
+            "lastSessionId": self.lastSessionId,
+            "laps": self.laps,
+            "segments": {str(segment): moments for segment, moments in self.segments.items()},
+            "histograms": {str(segment): {str(b): n for b, n in histogram.items()} for segment, histogram in self.histograms.items()},
+            "sessions": self.sessions,
+        }
+
+    # Fold in rows from HistoryStore.getHotTimes()
+    def addTimes(self, laps, segments, sessionStarts):
+        sessionIds = laps[:, 0].astype(int)
+        lapTimes = laps[:, 2]
+        addToMoments(self.laps, lapTimes, sessionIds, laps[:, 1])
+
+        # Per session moments, all sessions at once
+        ids, inverse = np.unique(sessionIds, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(ids))
+        sums = np.bincount(inverse, weights=lapTimes, minlength=len(ids))
+        sumSquares = np.bincount(inverse, weights=lapTimes*lapTimes, minlength=len(ids))
+        for sessionId, count, total, squares in zip(ids.tolist(), counts.tolist(), sums.tolist(), sumSquares.tolist()):
+            self.sessions.append([sessionId, sessionStarts.get(sessionId), count, total, squares])
+
+        segmentNumbers = segments[:, 2].astype(int)
+        for segment in np.unique(segmentNumbers).tolist():
+            rows = segments[segmentNumbers == segment]
+            addToMoments(self.segments.setdefault(segment, newMoments()), rows[:, 3], rows[:, 0], rows[:, 1])
+            bins, binCounts = np.unique(np.rint(rows[:, 3] / histogramBin).astype(int), return_counts=True)
+            histogram = self.histograms.setdefault(segment, {})
+            for b, n in zip(bins.tolist(), binCounts.tolist()):
+                histogram[b] = histogram.get(b, 0) + n
+
+        if 0 < len(laps) or 0 < len(segments):
+            self.lastSessionId = max([self.lastSessionId] + sessionIds.tolist() + segments[:, 0].astype(int).tolist())
+
+    def getBestLap(self):
+        return self.laps["best"]
+
+    # The best time on record for each of the numSegments segments of a lap (len(track.sectorEnds)),
+    # added up. None until every one of them has a time.
+    def getTheoreticalBest(self, numSegments):
+        if 0 == numSegments or any(segment not in self.segments for segment in range(1, numSegments+1)):
+            return None
+        bests = {segment: self.segments[segment]["best"] for segment in range(1, numSegments+1)}
+        return {"time": sum(best[0] for best in bests.values()), "segments": bests}
+
+    # Times at the given percentiles from a segment's histogram, to histogramBin
+    def getPercentiles(self, segment, percentiles):
+        histogram = self.histograms.get(segment, {})
+        if 0 == len(histogram):
+            return [None for p in percentiles]
+        bins = np.array(sorted(histogram.keys()))
+        cumulative = np.cumsum([histogram[b] for b in bins])
+        ranks = np.asarray(percentiles, dtype=float) / 100 * cumulative[-1]
+        found = np.minimum(np.searchsorted(cumulative, ranks, side='left'), len(bins)-1)
+        return (bins[found] * histogramBin).tolist()
+
+    # count, mean, standard deviation, best (time, session id, lap) and percentiles of every segment
+    def getSegmentStatistics(self, percentiles=(10, 50, 90)):
+        statistics = {}
+        for segment, moments in sorted(self.segments.items()):
+            statistics[segment] = {
+                "count": moments["count"],
+                "mean": getMean(moments["count"], moments["sum"]),
+                "stdDev": getStdDev(moments["count"], moments["sum"], moments["sumSquares"]),
+                "best": moments["best"],
+                "percentiles": dict(zip(percentiles, self.getPercentiles(segment, percentiles))),
+            }
+        return statistics
+
+    # Session by session, in the order they were driven: the mean and standard deviation of the hot
+    # laps of the session, and of all the hot laps of the last window sessions up to it
+    def getConsistency(self, window=5):
+        rows = sorted(self.sessions, key=lambda row: (row[1] or "", row[0]))
+        if 0 == len(rows):
+            return []
+        counts = np.array([row[2] for row in rows], dtype=float)
+        sums = np.array([row[3] for row in rows])
+        squares = np.array([row[4] for row in rows])
+        # Window totals from cumulative sums
+        def rolling(values):
+            cumulative = np.concatenate(([0.0], np.cumsum(values)))
+            return cumulative[1:] - cumulative[np.maximum(np.arange(1, len(values)+1) - window, 0)]
+        windowCounts, windowSums, windowSquares = rolling(counts), rolling(sums), rolling(squares)
+        consistency = []
+        for idx, row in enumerate(rows):
+            consistency.append({
+                "sessionId": row[0],
+                "sessionStart": row[1],
+                "laps": int(counts[idx]),
+                "mean": getMean(counts[idx], sums[idx]),
+                "stdDev": getStdDev(counts[idx], sums[idx], squares[idx]),
+                "rollingMean": getMean(windowCounts[idx], windowSums[idx]),
+                "rollingStdDev": getStdDev(windowCounts[idx], windowSums[idx], windowSquares[idx]),
+            })
+        return consistency
+
+# The accumulator for a track over the whole history, brought up to date with the sessions stored
+# since it was last saved
+def loadAccumulator(store, trackId):
+    accumulator = TrackAccumulator(store.getAnalyticsState(trackId))
+    laps, segments, starts = store.getHotTimes(trackId, accumulator.lastSessionId)
+    if 0 < len(laps) or 0 < len(segments):
+        accumulator.addTimes(laps, segments, starts)
+        store.setAnalyticsState(trackId, accumulator.getState())
+    return accumulator
+
+# An accumulator for the sessions started in [since, until) only - built from scratch, not saved
+def computeAccumulator(store, trackId, since=None, until=None):
+    accumulator = TrackAccumulator()
+    accumulator.addTimes(*store.getHotTimes(trackId, 0, since, until))
+    return accumulator
+
+def formatTime(seconds):
+    if seconds is None:
+        return "-"
+    return f"{math.trunc(seconds/60):02}:{seconds%60:0>6.3f}"
+
+# "file, lap N, date" for a (time, session id, lap) best
+def describeBest(store, best):
+    session = store.getSession(best[1])
+    return f"{session.sourceFile}, lap {best[2]}, {session.getSessionInfo('sessionDate')}"
+
+parser = argparse.ArgumentParser(description='Theoretical best, segment time distributions and consistency across the sessions at a track')
+parser.add_argument('-t', '--track', action='store', required=True, help='Track name or id (e.g. VIRfull)')
+parser.add_argument('--history-db', action='store', help='Session history database (default: ~/.local/share/PyRDA/history.sqlite3)')
+parser.add_argument('--since', action='store', help='Only sessions started on or after this date (YYYY-MM-DD)')
+parser.add_argument('--until', action='store', help='Only sessions started before this date (YYYY-MM-DD)')
+parser.add_argument('--window', type=int, default=5, help='Sessions in the rolling consistency window')
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    registry = trackRegistry.getRegistry()
+    track = registry.getTrack(args.track) or registry.findByName(args.track)
+    trackId = track.name if track is not None else args.track
+    store = HistoryStore(args.history_db)
+    if args.since or args.until:
+        accumulator = computeAccumulator(store, trackId, args.since, args.until)
+    else:
+        accumulator = loadAccumulator(store, trackId)
+
+    bestLap = accumulator.getBestLap()
+    if bestLap is None:
+        print("No hot laps on record for "+trackId)
+        store.close()
+        return
+    print(f"Best lap:         {formatTime(bestLap[0])}  ({describeBest(store, bestLap)})")
+    theoretical = accumulator.getTheoreticalBest(len(track.sectorEnds)) if track is not None else None
+    if theoretical is not None:
+        print(f"Theoretical best: {formatTime(theoretical['time'])}  ({bestLap[0] - theoretical['time']:.3f} s under the best lap)")
+
+    print()
+    print(f"{'Segment':>8}{'Laps':>7}{'Best':>10}{'Mean':>10}{'Std dev':>9}{'10%':>9}{'50%':>9}{'90%':>9}  Best from")
+    for segment, stats in accumulator.getSegmentStatistics().items():
+        p = stats["percentiles"]
+        print(f"{segment:>8}{stats['count']:>7}{stats['best'][0]:>10.3f}{stats['mean']:>10.3f}{stats['stdDev']:>9.3f}"
+              f"{p[10]:>9.2f}{p[50]:>9.2f}{p[90]:>9.2f}  {describeBest(store, stats['best'])}")
+
+    print()
+    print(f"{'Session start':<22}{'Laps':>5}{'Mean':>11}{'Std dev':>9}{'Rolling mean':>14}{'Rolling std dev':>17}")
+    for row in accumulator.getConsistency(args.window):
+        print(f"{str(row['sessionStart']):<22}{row['laps']:>5}{formatTime(row['mean']):>11}{row['stdDev']:>9.3f}"
+              f"{formatTime(row['rollingMean']):>14}{row['rollingStdDev']:>17.3f}")
+    store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Track registry.
+# Every module in tracks/ that defines a track (description, startpoint, sectorEnds, enterTrackPoint,
+# exitTrackPoint) is found automatically - adding a track is just adding a file. Tracks are looked up
+# by the name in the data file, or, when there is none, by where the first GPS fixes of the session are.
+# Each track is compiled once per process into the form the lap detection and trimming code uses:
+# its waypoints projected onto a flat plane around the start/finish line, in feet, so distances to
+# them are plain hypotenuses.
+#
+# A track module can also set nameKeywords, a list of words that must all appear (case-insensitive)
+# in a track name for it to match. The default is the module name.
+
+import os.path
+import importlib
+import pkgutil
+import numpy as np
+import utils
+
+tracksDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tracks")
+trackAttributes = ["description", "startpoint", "sectorEnds", "enterTrackPoint", "exitTrackPoint"]
+
+# How far (in degrees, about half a mile) around the track's waypoints a session can start and still
+# be matched to it - it covers the paddock and pit lane.
+boundsMargin = 0.008
+
+class CompiledTrack:
+    def __init__(self, name, module):
+        self.name = name
+        self.description = module.description
+        self.startpoint = tuple(module.startpoint)
+        self.sectorEnds = [tuple(point) for point in module.sectorEnds]
+        self.enterTrackPoint = tuple(module.enterTrackPoint)
+        self.exitTrackPoint = tuple(module.exitTrackPoint)
+        self.nameKeywords = [word.lower() for word in getattr(module, "nameKeywords", [name])]
+
+        # Lap detection looks for the waypoints in this order: onto the track, then each sector end,
+        # the last of which is the start/finish line.
+        self.targets = [self.enterTrackPoint] + self.sectorEnds
+        # The per-track projection is centred on the start/finish line
+        self.origin = self.startpoint
+        self.targetsXY = self.project(self.targets)
+        self.enterXY = self.project([self.enterTrackPoint])[0]
+        self.exitXY = self.project([self.exitTrackPoint])[0]
+
+        points = np.array(self.targets + [self.startpoint, self.exitTrackPoint])
+        self.south, self.west = points.min(axis=0) - boundsMargin
+        self.north, self.east = points.max(axis=0) + boundsMargin
+
+    # (lat, lng) points to feet east and north of the start/finish line
+    def project(self, points):
+        return utils.projectLocal(points, self.origin)
+
+    # Distances in feet from each of N (lat, lng) points to each of K projected points: N x K
+    def distances(self, positions, pointsXY):
+        xy = self.project(positions)
+        pointsXY = np.asarray(pointsXY).reshape(-1, 2)
+        return np.hypot(xy[:, 0, None] - pointsXY[None, :, 0], xy[:, 1, None] - pointsXY[None, :, 1])
+
+    def contains(self, lat, lng):
+        return self.south <= lat <= self.north and self.west <= lng <= self.east
+
+    def matchesName(self, trackName):
+        trackName = trackName.lower()
+        if trackName in (self.name.lower(), self.description.lower()):
+            return True
+        return all(word in trackName for word in self.nameKeywords)
+
+class TrackRegistry:
+    def __init__(self, directory=tracksDir, package="tracks"):
+        self.tracks = {}
+        for moduleInfo in sorted(pkgutil.iter_modules([directory]), key=lambda m: m.name):
+            module = importlib.import_module(package+"."+moduleInfo.name)
+            if all(hasattr(module, attribute) for attribute in trackAttributes):
+                self.tracks[moduleInfo.name] = CompiledTrack(moduleInfo.name, module)
+
+    def getTrack(self, name):
+        return self.tracks.get(name)
+
+    def findByName(self, trackName):
+        for track in self.tracks.values():
+            if track.matchesName(trackName):
+                return track
+        return None
+
+    # The track whose area contains the point - the one with the nearest start/finish line if
+    # several do
+    def findByLocation(self, lat, lng):
+        candidates = [track for track in self.tracks.values() if track.contains(lat, lng)]
+        if 0 == len(candidates):
+            return None
+        distances = utils.calculateGPSdistances((lat, lng), [track.startpoint for track in candidates])
+        return candidates[int(np.argmin(distances))]
+
+    # Match a session from its first GPS fixes (an N x 2 array of lat, lng). Samples from before the
+    # receiver has a fix read as 0, 0 and are skipped.
+    def findByPositions(self, positions, numFixes=50):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        valid = positions[np.all(np.isfinite(positions), axis=1) & np.any(positions != 0, axis=1)]
+        if 0 == len(valid):
+            return None
+        lat, lng = np.median(valid[:numFixes], axis=0)
+        return self.findByLocation(float(lat), float(lng))
+
+registry = None
+
+# The registry is built, and every track compiled, once per process
+def getRegistry():
+    global registry
+    if registry is None:
+        registry = TrackRegistry()
+    return registry
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+# Words that identify this track in a data file's track name
+nameKeywords = ["roebling"]
 description = "Roebling Road Raceway"
 startpoint = (32.167035, -81.322826)
 sectorEnds = [(32.168012, -81.327226),
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+# Words that identify this track in a data file's track name
+nameKeywords = ["sebring"]
 description = "Sebring Internation Raceway"
 startpoint = (27.450234, -81.353699)
 sectorEnds = [(27.451577, -81.348501),
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+# Words that identify this track in a data file's track name
+nameKeywords = ["vir", "full"]
 description = "VIRginia International Raceway - Full Course"
 startpoint = (36.568801, -79.206653)
 sectorEnds = [(36.568248, -79.204926), 
@@ -3,99 +3,144 @@
 # Main file for track session analysis.
 
 from dataImporter import *
-from datamodel import TrackSession
+from sessionCache import SessionCache, getOptions
+from historyStore import HistoryStore
 import pathlib
 import argparse
-from openpyxl import load_workbook
 import datetime
-import os, os.path, shutil, io
+import os, os.path
 import utils
-import base64
 
 parser = argparse.ArgumentParser(description='Update lap time record spreadsheet')
 parser.add_argument('-d', '--dir', action='append', help='Directory containing CSV datafiles with lap data to be recorded.')
 parser.add_argument('-v', '--verbose', action='count')
+parser.add_argument('-w', '--workbook', action='store', default='/nfshome/jberning/TrackTimes.xlsx', help='Lap time record workbook to update (default: %(default)s)')
 parser.add_argument('-t', '--trackname', action='store', help='Name of track data is from, if not present in file.')
 parser.add_argument('--gps-only', action='store_true', help='Perform analysis only on GPS data (e.g. AIM Solo 2 non-DL data)', default=False)
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to parse in parallel worker processes')
+parser.add_argument('--no-cache', action='store_true', help='Parse every data file again instead of reusing cached sessions', default=False)
+parser.add_argument('--cache-dir', action='store', help='Directory for the processed session cache (default: ~/.cache/PyRDA/sessions)')
+parser.add_argument('--history-db', action='store', help='Session history database (default: ~/.local/share/PyRDA/history.sqlite3)')
 
-args = parser.parse_args()
+# Set by main(), and in worker processes by setArgs()
+args = None
+
+def setArgs(newArgs):
+    global args
+    args = newArgs
 
 def debugout(debuglevel, text):
     if args.verbose and args.verbose >= debuglevel:
         print(text)
 
-def analyze(dirName, sessions):
-    sessionTimes = [s.getSessionInfo("sessionTime") for s in sessions]
-
-#    outputFilename = '-'.join([session.getSessionInfo("driverName"),
-#                               session.getSessionInfo("trackName"),
-#                               session.getSessionInfo("sessionDate"),
-#                               session.getSessionInfo("sessionTime")])
-#    outputFilename += '.pdf'
-
-    # Tell us which session we're looking at
-    #debugout(1, f'Analyzing data from { sessions.getSessionInfo("sourcefile") }')
-    #if session.getSessionInfo('trackName') is not None:
-    #    debugout(1, f'Track name: { session.getSessionInfo("trackName") }') 
-    #if session.getSessionInfo('trackDescription') is not None:
-    #    debugout(1, f'Track description: { session.getSessionInfo("trackDescription") }') 
-    #if session.getSessionInfo('sessionDate') is not None:
-    #    debugout(1, f'Session date: { session.getSessionInfo("sessionDate") }') 
-    #if session.getSessionInfo('sessionTime') is not None:
-    #    debugout(1, f'Session time: { session.getSessionInfo("sessionTime") }') 
-
-    debugout(2, "Opening workbook")
-    workbook = load_workbook("/nfshome/jberning/TrackTimes.xlsx")
-    if dirName not in workbook.sheetnames:
-        debugout(1, "Adding sheet name "+dirName)
-        sheet = workbook.create_sheet(title=dirName)
-    else:
-        sheet = workbook[dirName]
-
-    sheet['A1'] = "Date"
-    sheet['B1'] = sessions[0].getSessionInfo("sessionDate")
-    sheet['A2'] = "Track"
-    sheet['B2'] = sessions[0].getSessionInfo("trackName")
-    sheet['A6'] = "Lap#"
-    sheet['A25'] = "Std Dev"
-    for f in range(15):
-        sheet['A'+str(7+f)] = f+1
+# Bump when the sheet layout changes, so every sheet is written again
+SHEET_LAYOUT_VERSION = 2
+# Rows kept for lap times even when no session has that many hot laps, so short days line up with
+# the older sheets
+minimumLapRows = 15
+minimumColumns = 8
+
+# Identifies what a sheet is built from: the data files' content and the import options, in order
+def getSheetFingerprint(sessions):
+    return utils.makeKey("sheet", SHEET_LAYOUT_VERSION, getOptions(args, False), [s.contentHash for s in sessions])
+
+# Everything written to one sheet: a dict of cell -> (value, number format or None), plus the lap
+# time columns. One column per session from B on, one row per hot lap from row 7 on, sized to the
+# sessions rather than to a fixed grid.
+def layoutSheet(sessions):
+    from openpyxl.utils import get_column_letter
+    timeFormat = "mm:ss.000"
+    numRows = max([minimumLapRows] + [len(s.getHotLapTimes()) for s in sessions])
+    lastLapRow = 7 + numRows - 1
+    stdDevRow = lastLapRow + 4
+    fastestRow = stdDevRow + 3
+    columns = [get_column_letter(2+idx) for idx in range(max(minimumColumns, len(sessions)))]
+
+    cells = {}
+    cells['A1'] = ("Date", None)
+    cells['B1'] = (sessions[0].getSessionInfo("sessionDate"), None)
+    cells['A2'] = ("Track", None)
+    cells['B2'] = (sessions[0].getSessionInfo("trackName"), None)
+    cells['A6'] = ("Lap#", None)
+    cells['A'+str(stdDevRow)] = ("Std Dev", None)
+    for f in range(numRows):
+        cells['A'+str(7+f)] = (f+1, None)
     # Set time heading, fill in the times
-    for idx, session in enumerate(sessions):
-        column = chr(ord('B')+idx)
-        sheet[column+'6'] = session.getSessionInfo("sheetDateTime")
-        for lidx, lapTime in enumerate(session.getLapTimes()[1:-1]):
-            sheet[column+str(7+lidx)] = datetime.timedelta(seconds=lapTime)
-            sheet[column+str(7+lidx)].number_format = "mm:ss.000"
-        sheet[column+'25'] = '=_xlfn.STDEV.P('+column+'7:'+column+'21)'
-        sheet[column+'25'].number_format = "mm:ss.000"
-    
-    sheet['A28'] = "Fastest overall lap:"
-    sheet['A29'] = "=MIN(B7:I21)"
-    sheet['A29'].number_format = "mm:ss.000"
-    for col in 'BCDEFGHI':
+    for column, session in zip(columns, sessions):
+        cells[column+'6'] = (session.getSessionInfo("sheetDateTime"), None)
+        for lidx, lapTime in enumerate(session.getHotLapTimes()):
+            cells[column+str(7+lidx)] = (datetime.timedelta(seconds=lapTime), timeFormat)
+        cells[column+str(stdDevRow)] = ('=_xlfn.STDEV.P('+column+'7:'+column+str(lastLapRow)+')', timeFormat)
+
+    cells['A'+str(fastestRow)] = ("Fastest overall lap:", None)
+    cells['A'+str(fastestRow+1)] = ("=MIN(B7:"+columns[-1]+str(lastLapRow)+")", timeFormat)
+    return cells, columns
+
+def writeSheet(workbook, sheetName, cells, columns):
+    if sheetName not in workbook.sheetnames:
+        debugout(1, "Adding sheet name "+sheetName)
+        sheet = workbook.create_sheet(title=sheetName)
+    else:
+        sheet = workbook[sheetName]
+        # The layout grows and shrinks with the sessions - empty the sheet so nothing from the last
+        # layout is left past the end of this one
+        for row in sheet.iter_rows():
+            for cell in row:
+                cell.value = None
+                cell.number_format = "General"
+    for cell, (value, numberFormat) in cells.items():
+        sheet[cell] = value
+        if numberFormat is not None:
+            sheet[cell].number_format = numberFormat
+    for col in columns:
         sheet.column_dimensions[col].width = 15
 
-    workbook.save("/nfshome/jberning/TrackTimes.xlsx")
-
-def slurpDir(dirName):
+# Only the session metadata, lap and segment times go into the history store, so that is all that is
+# kept (and, with --jobs, all that is sent back from the worker processes).
+def summarizeFile(file):
+    debugout(1, "Working on file: "+file)
+    if args.no_cache:
+        return loadSession(file, args, trim=False).getSummary()
+    return SessionCache(args.cache_dir).loadSession(file, args, trim=False).getSummary()
+
+# The sheet name and the stored sessions for a directory of data files. Files already in the history
+# store are not read again - only the new ones are imported.
+def slurpDir(store, dirName):
     if dirName.endswith('/'):
         dirName = dirName[:-1]
-    files = [str(f) for f in pathlib.Path().glob(dirName+"/*.csv")]
-
-    runs = []
-    for file in files:
-        debugout(1, "Working on file: "+file)
-        dataReader = getFileImporter(file)
-        runs.append(dataReader.readSessionData(args))
-        runs[-1].addSessionInfo(sourcefile = file)
-
-
-    analyze(os.path.basename(dirName), runs)
-
-def main():
+    files = sorted(str(f) for f in pathlib.Path().glob(dirName+"/*.csv"))
+    sessionIds = store.ingestFiles(files, args, False, summarizeFile, args.jobs, initializer=setArgs, initargs=(args,))
+    return os.path.basename(dirName), [store.getSession(sessionId) for sessionId in sessionIds]
+
+# All the sheets are laid out first; the workbook is then opened once, only if any sheet changed, and
+# saved once with all the changes. openpyxl is only imported when there is something to write.
+def main(argv=None):
+    setArgs(parser.parse_args(argv))
+    store = HistoryStore(args.history_db)
+    changes = {}
+    fingerprints = {}
     for dir in args.dir:
-        slurpDir(dir)
+        sheetName, runs = slurpDir(store, dir)
+        if 0 == len(runs):
+            debugout(1, "No data files in "+dir)
+            continue
+        fingerprint = getSheetFingerprint(runs)
+        if store.getSheetFingerprint(args.workbook, sheetName) == fingerprint:
+            debugout(1, "Sheet "+sheetName+" is up to date")
+            continue
+        changes[sheetName] = layoutSheet(runs)
+        fingerprints[sheetName] = fingerprint
+
+    if 0 < len(changes):
+        debugout(2, "Opening workbook")
+        from openpyxl import load_workbook
+        previousStamp = store.getWorkbookStamp(args.workbook)
+        workbook = load_workbook(args.workbook)
+        for sheetName, (cells, columns) in changes.items():
+            writeSheet(workbook, sheetName, cells, columns)
+        workbook.save(args.workbook)
+        store.setSheetFingerprints(args.workbook, previousStamp, fingerprints)
+    store.close()
 
 if __name__ == '__main__':
     main()
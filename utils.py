@@ -1,14 +1,209 @@
 #!/usr/bin/python3
 
 # Utility functions
-import geopy.distance
+# geopy is only needed for the reference distances, and is imported where those are computed
 import statistics
 import pprint
+import hashlib
+import json
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# WGS-84 ellipsoid, the same model geopy's geodesic solver uses
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+EARTH_RADIUS_METERS = 6371008.8
+FEET_PER_METER = 1/0.3048
 
 def calculateGPSdistance(location1, location2):
+  import geopy.distance
   distanceInFeet = geopy.distance.distance(location1, location2).feet
   return distanceInFeet
 
+# Meridional and prime vertical radii of curvature (meters) at the given latitudes (radians)
+def earthRadii(lat):
+  w2 = 1 - WGS84_E2*np.sin(lat)**2
+  meridional = WGS84_A*(1-WGS84_E2)/(w2*np.sqrt(w2))
+  primeVertical = WGS84_A/np.sqrt(w2)
+  return meridional, primeVertical
+
+# Batch version of calculateGPSdistance. Takes an array of (lat, lng) points and either a single
+# reference point or an array of them, and returns distances in feet - shape (N,) for a single
+# reference, (N, M) for M references.
+# Methods:
+#   "local"     - flat-earth projection around each pair's mid-latitude using the WGS-84 radii of
+#                 curvature. Well under an inch of error over the few thousand feet a track spans.
+#   "haversine" - great circle on a sphere of mean earth radius. Off by up to ~0.5%.
+#   "geodesic"  - geopy's full solve per pair, for reference only. Slow.
+def calculateGPSdistances(points, references, method="local"):
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  references = np.asarray(references, dtype=float)
+  singleReference = 1 == references.ndim
+  references = references.reshape(-1, 2)
+
+  if "geodesic" == method:
+    distances = np.empty((len(points), len(references)))
+    for i, point in enumerate(points):
+      for j, reference in enumerate(references):
+        distances[i, j] = calculateGPSdistance(tuple(point), tuple(reference))
+  else:
+    lat1 = np.radians(points[:, 0])[:, None]
+    lng1 = np.radians(points[:, 1])[:, None]
+    lat2 = np.radians(references[:, 0])[None, :]
+    lng2 = np.radians(references[:, 1])[None, :]
+    if "local" == method:
+      meridional, primeVertical = earthRadii((lat1+lat2)/2)
+      north = (lat2-lat1)*meridional
+      east = (lng2-lng1)*primeVertical*np.cos((lat1+lat2)/2)
+      distances = np.hypot(north, east)*FEET_PER_METER
+    elif "haversine" == method:
+      h = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lng2-lng1)/2)**2
+      distances = 2*EARTH_RADIUS_METERS*np.arcsin(np.sqrt(np.minimum(h, 1.0)))*FEET_PER_METER
+    else:
+      raise ValueError("Unknown distance method: "+str(method))
+
+  if singleReference:
+    return distances[:, 0]
+  return distances
+
+# Distances between consecutive points of a trace, in feet. Element i is the step from point i-1
+# to point i; element 0 is always 0.
+def calculateStepDistances(points, method="local"):
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  steps = np.zeros(len(points))
+  if len(points) > 1:
+    lat1 = np.radians(points[:-1, 0])
+    lat2 = np.radians(points[1:, 0])
+    dlng = np.radians(points[1:, 1] - points[:-1, 1])
+    if "local" == method:
+      meridional, primeVertical = earthRadii((lat1+lat2)/2)
+      steps[1:] = np.hypot((lat2-lat1)*meridional, dlng*primeVertical*np.cos((lat1+lat2)/2))*FEET_PER_METER
+    else:
+      steps[1:] = [calculateGPSdistances(points[i], points[i-1], method)[0] for i in range(1, len(points))]
+  return steps
+
+# Linear interpolation of every row of rows (channels x samples, sampled at the non-decreasing
+# positions x) at the grid positions, all rows at once: one searchsorted for the whole grid, then one
+# weighted sum. NaN outside the range of x. Where x repeats (a stationary car) the later sample is used.
+def interpolateRows(x, rows, grid):
+  x = np.asarray(x, dtype=float)
+  rows = np.asarray(rows, dtype=float)
+  grid = np.asarray(grid, dtype=float)
+  result = np.full((rows.shape[0], len(grid)), np.nan)
+  if len(x) < 2:
+    return result
+  hi = np.clip(np.searchsorted(x, grid, side='right'), 1, len(x)-1)
+  lo = hi - 1
+  span = x[hi] - x[lo]
+  weight = np.divide(grid - x[lo], span, out=np.ones_like(grid), where=span > 0)
+  inside = (grid >= x[0]) & (grid <= x[-1])
+  result[:, inside] = rows[:, lo[inside]]*(1-weight[inside]) + rows[:, hi[inside]]*weight[inside]
+  return result
+
+# Project (lat, lng) points onto a flat plane tangent at origin: returns an N x 2 array of feet east and
+# feet north of the origin. Accurate to well under an inch over a race track.
+def projectLocal(points, origin):
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  lat0 = np.radians(origin[0])
+  meridional, primeVertical = earthRadii(lat0)
+  north = np.radians(points[:, 0] - origin[0])*meridional*FEET_PER_METER
+  east = np.radians(points[:, 1] - origin[1])*primeVertical*np.cos(lat0)*FEET_PER_METER
+  return np.column_stack((east, north))
+
+# Inverse of projectLocal: feet east and north of origin back to (lat, lng) pairs
+def unprojectLocal(xy, origin):
+  xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+  lat0 = np.radians(origin[0])
+  meridional, primeVertical = earthRadii(lat0)
+  lat = origin[0] + np.degrees(xy[:, 1]/FEET_PER_METER/meridional)
+  lng = origin[1] + np.degrees(xy[:, 0]/FEET_PER_METER/(primeVertical*np.cos(lat0)))
+  return np.column_stack((lat, lng))
+
+# Part of the session cache key, as the significance of the traces drawn is kept in the cache - bump
+# when traceSignificance() changes
+SIGNIFICANCE_VERSION = 1
+
+# Douglas-Peucker significance of every point of a trace: the largest tolerance (in feet) at which the
+# point survives simplification, with the endpoints always kept. Simplifying to any tolerance is then
+# just "significance > tolerance", so one computation serves every zoom level.
+# Rather than recursing range by range, every open range at one depth of the recursion is handled in
+# the same set of array operations - the Python loop runs once per depth, not once per point.
+def traceSignificance(points):
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  significance = np.zeros(len(points))
+  if 0 == len(points):
+    return significance
+  xy = projectLocal(points, points[0])
+  significance[0] = significance[-1] = np.inf
+
+  starts = np.array([0])
+  ends = np.array([len(points)-1])
+  limits = np.array([np.inf])
+  while True:
+    hasInterior = ends - starts > 1
+    starts, ends, limits = starts[hasInterior], ends[hasInterior], limits[hasInterior]
+    if 0 == len(starts):
+      break
+    counts = ends - starts - 1
+    offsets = np.cumsum(counts) - counts
+    rangeIds = np.repeat(np.arange(len(starts)), counts)
+    interior = np.arange(counts.sum()) - offsets[rangeIds] + starts[rangeIds] + 1
+
+    # Distance from each interior point to the segment joining its range's endpoints
+    a = xy[starts[rangeIds]]
+    ab = xy[ends[rangeIds]] - a
+    ap = xy[interior] - a
+    lengthSq = np.einsum('ij,ij->i', ab, ab)
+    t = np.clip(np.einsum('ij,ij->i', ap, ab)/np.where(lengthSq > 0, lengthSq, 1), 0, 1)
+    distances = np.hypot(*(ap - t[:, None]*ab).T)
+
+    # Farthest point of each range (the first one, on ties)
+    maxDistances = np.maximum.reduceat(distances, offsets)
+    atMax = np.flatnonzero(distances == maxDistances[rangeIds])
+    firstOfRange = np.unique(rangeIds[atMax], return_index=True)[1]
+    chosen = interior[atMax[firstOfRange]]
+
+    # A point can't outlive the point that split its range
+    chosenSignificance = np.minimum(maxDistances, limits)
+    significance[chosen] = chosenSignificance
+    starts, ends = np.concatenate((starts, chosen)), np.concatenate((chosen, ends))
+    limits = np.concatenate((chosenSignificance, chosenSignificance))
+  return significance
+
+# Bounded-error check for the fast methods: compares against geopy's geodesic distance on an evenly
+# spaced subset of the points and returns the largest absolute difference in feet.
+def checkGPSdistanceError(points, references, method="local", sampleSize=50):
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  if 0 == len(points):
+    return 0.0
+  subset = points[np.unique(np.linspace(0, len(points)-1, min(sampleSize, len(points))).astype(int))]
+  fast = calculateGPSdistances(subset, references, method)
+  exact = calculateGPSdistances(subset, references, "geodesic")
+  return float(np.max(np.abs(fast - exact)))
+
+# Map func over items on a pool of worker processes, yielding the results in the same order as items.
+# At most maxInFlight items (default: twice the number of workers) are submitted but not yet consumed,
+# so a long list of files never has all of its results in memory at once. With jobs <= 1 everything
+# runs in this process, one item at a time. func must be picklable - a module level function or a
+# functools.partial of one. initializer(*initargs) runs once in each worker process as it starts, e.g.
+# to hand it the parsed command line.
+def parallelMap(func, items, jobs=1, maxInFlight=None, initializer=None, initargs=()):
+  if not jobs or jobs <= 1:
+    for item in items:
+      yield func(item)
+    return
+  if not maxInFlight:
+    maxInFlight = 2*jobs
+  with ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs) as pool:
+    inFlight = deque()
+    for item in items:
+      inFlight.append(pool.submit(func, item))
+      if len(inFlight) >= maxInFlight:
+        yield inFlight.popleft().result()
+    while inFlight:
+      yield inFlight.popleft().result()
+
 # The normal Python list sorting functions are behaving strangely. I think because the list is a complex type.
 # So, we're going back to basics and doing a recursive sort here.
 def sortSegments(listToSort):
@@ -45,5 +240,29 @@ def stdDevFilter(times):
   floatList = [float(x) for x in times]
   return statistics.pstdev(floatList)
 
+# Feed the parts of a key into a hash. Arrays are hashed by type, shape and content; lists and tuples
+# part by part; anything else by its JSON (or repr) form.
+def updateDigest(digest, part):
+  if isinstance(part, np.ndarray):
+    digest.update(("array:"+part.dtype.str+":"+repr(part.shape)+":").encode())
+    digest.update(np.ascontiguousarray(part).tobytes())
+  elif isinstance(part, (list, tuple)):
+    digest.update(("seq:"+str(len(part))+":").encode())
+    for item in part:
+      updateDigest(digest, item)
+  else:
+    try:
+      encoded = json.dumps(part, sort_keys=True)
+    except TypeError:
+      encoded = repr(part)
+    digest.update(("value:"+encoded+";").encode())
+
+# A cache key (hex SHA-256) for everything that goes into making something: the artifact cache's images
+# and PDFs, and updateSpreadsheet's sheet fingerprints
+def makeKey(*parts):
+  digest = hashlib.sha256()
+  updateDigest(digest, parts)
+  return digest.hexdigest()
+
 if __name__ == '__main__':
   print("This file should not be called directly.")
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# Brake and throttle zones.
+# A channel is split into bands by thresholds (e.g. throttle: idle, partial, most, full) and
+# run-length encoded into zones - contiguous runs of samples in the same band. Maps draw one
+# polyline per zone instead of one marker per sample, and the zones themselves (where the brake
+# goes on, where it is released, how long the zone is) go into the report.
+
+import numpy as np
+import utils
+from datamodel import SessionSlice
+
+# Band edges: a sample is in band i when it is above edges[i-1] and at most edges[i] - the top band has
+# no upper limit, and band 0 (at or below the first edge) is "off".
+brakeBands = [0]
+# Even at idle, there is some throttle positive position. The first throttle edge may require adjustment.
+throttleBands = [5, 35, 75]
+
+# Zones shorter than this many feet (a single sample at the end of a stretch, or the car standing still)
+# are left out - they would be reported as 0 ft long
+minimumZoneLength = 1.0
+
+brakeColors = {1: "red"}
+throttleColors = {1: "green", 2: "lightgreen", 3: "orange"}
+
+class Zone:
+    def __init__(self, path, trace, band, peak, mean, startDistance, stopDistance):
+        self.path = path
+        # The zone carried on to the first sample after it, so that neighbouring zones join up on a map
+        self.trace = trace
+        self.band = band
+        self.peak = peak
+        self.mean = mean
+        # Distances in feet from the start of the stretch the zones were extracted from. A zone ends at
+        # the first sample after it - where the brake or throttle was seen to change - so its length and
+        # duration take in the step to that sample, and a single sample zone isn't 0 ft long.
+        self.startDistance = startDistance
+        self.stopDistance = stopDistance
+        self.length = stopDistance - startDistance
+        self.duration = trace.elapsed()
+
+# Zones of one channel over a stretch of samples (a SessionSlice - usually one lap's segment).
+# Only zones above band 0 are returned, in driving order.
+def extractZones(stretch, channel, bands):
+    values = stretch[channel]
+    if 0 == len(values):
+        return []
+    levels = np.digitize(values, bands, right=True)
+    changes = np.flatnonzero(np.diff(levels)) + 1
+    starts = np.concatenate(([0], changes))
+    stops = np.concatenate((changes, [len(values)]))
+    peaks = np.maximum.reduceat(values, starts)
+    means = np.add.reduceat(values, starts) / (stops - starts)
+    distances = np.cumsum(utils.calculateStepDistances(stretch.positions()))
+
+    zones = []
+    for start, stop, level, peak, mean in zip(starts.tolist(), stops.tolist(), levels[starts].tolist(), peaks.tolist(), means.tolist()):
+        if 0 == level:
+            continue
+        path = SessionSlice(stretch.session, stretch.start+start, stretch.start+stop)
+        trace = SessionSlice(stretch.session, stretch.start+start, stretch.start+min(stop+1, len(values)))
+        stopDistance = float(distances[min(stop, len(values)-1)])
+        if stopDistance - float(distances[start]) < minimumZoneLength:
+            continue
+        zones.append(Zone(path, trace, level, peak, mean, float(distances[start]), stopDistance))
+    return zones
+
+def getBrakeZones(stretch):
+    return extractZones(stretch, "brake", brakeBands)
+
+def getThrottleZones(stretch):
+    return extractZones(stretch, "throttle", throttleBands)
+
+# Draw zones on a map (or MapSpec) as one colored polyline each
+def addZonesToMap(zoneMap, zones, colors):
+    for zone in zones:
+        zoneMap.addPolyline(zone.trace.positions(), color=colors[zone.band], smoothFactor=0.0)